@@ -7,89 +7,306 @@ from aqt import mw
 from aqt.qt import *
 
 import re
+import os
+import cgi
+import json
+import multiprocessing
+import hashlib
+from itertools import islice
+from operator import itemgetter
 import anki.utils
 import anki.importing
 import anki.hooks
-from anki.importing.noteimp import NoteImporter
+from anki.importing.noteimp import NoteImporter, ForeignNote
+from anki.consts import NEW_CARDS_RANDOM
+from anki.lang import _, ngettext
 
 from openpyxl import load_workbook
 import pprint as pp
 #from aqt.qt import debug; debug()
 
+# the header is looked for in this many rows at the top of a sheet
+HEADER_SCAN_ROWS = 10
+# notes imported and saved to the collection at a time
+BATCH_SIZE = 2000
+# skip the rows that have not changed since the workbook was last imported
+# into this collection and whose notes are still there
+INCREMENTAL = False
+# titles of the sheets to import, None for every sheet with a header
+SHEETS = None
+# worker processes parsing the sheets, None for one per CPU; with 1 the
+# sheets are parsed one after another in Anki's process
+PROCESSES = None
+
+def loadWorkbook(file):
+    # read-only workbooks stream their rows from the file instead of
+    # building every cell of the sheet in memory; data_only gives the last
+    # calculated result of a formula instead of the formula itself
+    try:
+        return load_workbook(filename = file, read_only = True, data_only = True)
+    except TypeError:
+        # openpyxl before 2.4 calls the read-only mode use_iterators
+        return load_workbook(filename = file, use_iterators = True, data_only = True)
+
+def rowValues(row):
+    return tuple(cell.value for cell in row)
+
+# field text of a cell value by its type; strings, rich text included,
+# are kept as they are, anything else, dates too, is converted with str()
+CONVERTERS = {
+    unicode: unicode,
+    str: str,
+}
+
+def columnGetter(columns):
+    "Takes the values of the columns from a row, always as a tuple."
+    if len(columns) == 1:
+        c = columns[0]
+        return lambda row: (row[c],)
+    if not columns:
+        return lambda row: ()
+    return itemgetter(*columns)
+
+def noteField(text, allowHTML):
+    "The field as importNotes stores the text of a cell."
+    if not allowHTML:
+        text = cgi.escape(text)
+    return text.strip().replace("\n", "<br>")
+
+class RowFingerprints(object):
+    """Fingerprints of the rows imported from a workbook by their sheet and
+    key, the field mapped to the first field of the model. They are kept in
+    a file next to the workbook and only apply to the same collection and
+    model; the mapping of the sheet is part of each fingerprint. A row is
+    only skipped while the model has a note with its key."""
+
+    def __init__(self, file, col, model, allowHTML):
+        self.path = file + ".fingerprints"
+        self.allowHTML = allowHTML
+        self.settings = {'collection': col.crt, 'model': model}
+        self.keys = set(anki.utils.splitFields(flds)[0] for flds in
+                        col.db.list("select flds from notes where mid = ?", model))
+        self.rows = {}
+        # fingerprints of the rows read since the last commit
+        self.pending = {}
+        self.skipped = self.updated = self.added = 0
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.load(f)
+            if data.get('settings') == self.settings:
+                self.rows = data['rows']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def keep(self, sheet, mapping, keyIndex):
+        """The keep(fields) filter of makeNotes for a sheet, true for the rows
+        that are new or changed since they were imported."""
+        salt = u"\x1f".join([sheet] + [field or u"" for field in mapping])
+        def changed(fields):
+            key = u"%s\x1f%s" % (sheet, fields[keyIndex])
+            fingerprint = hashlib.sha1(u"\x1f".join([salt] + fields).encode('utf8')).hexdigest()
+            old = self.rows.get(key)
+            if old == fingerprint and noteField(fields[keyIndex], self.allowHTML) in self.keys:
+                self.skipped += 1
+                return False
+            if old is None:
+                self.added += 1
+            else:
+                self.updated += 1
+            self.pending[key] = fingerprint
+            return True
+        return changed
+
+    def commit(self):
+        "Remembers the rows read so far, once they are saved to the collection."
+        self.rows.update(self.pending)
+        self.pending = {}
+
+    def save(self, log):
+        "Writes the fingerprints, the import succeeded even if it fails."
+        try:
+            with open(self.path, 'wb') as f:
+                json.dump({'settings': self.settings, 'rows': self.rows}, f)
+        except (IOError, OSError) as e:
+            log.append("Unable to save the fingerprints to '%s': %s" % (self.path, e))
+
+def makeNotes(rows, keep=None):
+    "Notes of the field values of the rows, but those keep(fields) is false for."
+    for flds in rows:
+        if keep and not keep(flds):
+            continue
+        note = ForeignNote()
+        note.fields = flds
+        yield note
+
+def sheetRows(job, workbook=None):
+    """The title, mapping and field values of the rows of a sheet. Sheets with
+    the same header as the first one use its mapping, the columns of the others
+    are mapped to the fields of the same name. The sheet is read from the
+    workbook if it is already open."""
+    file, title, header, mapping, fieldNames = job
+    data = ExcelImporter._Data([])
+    data.openWorkbook(file, title, workbook)
+    if data.header != header:
+        mapping = data.mappingFor(fieldNames)
+    return title, mapping, data.readFields(tuple(mapping))
+
+def readSheet(job):
+    # runs in a worker process, the rows are sent back as a list
+    title, mapping, rows = sheetRows(job)
+    return title, mapping, list(rows)
+
+def parseSheets(jobs, processes=PROCESSES, workbook=None):
+    """Generates the sheetRows of the jobs in order. Several sheets are parsed
+    in a pool of worker processes where Anki's process can be forked, and one
+    after another from the same open workbook otherwise; the caller alone
+    writes to the collection."""
+    if processes is None:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    pool = None
+    if processes > 1 and len(jobs) > 1 and hasattr(os, 'fork'):
+        try:
+            pool = multiprocessing.Pool(processes)
+        except (OSError, NotImplementedError):
+            pass
+    if not pool:
+        # loading a workbook parses all of its shared strings, it is done once
+        if workbook is None and jobs:
+            workbook = loadWorkbook(jobs[0][0])
+        for job in jobs:
+            yield sheetRows(job, workbook)
+        return
+    try:
+        for result in pool.imap(readSheet, jobs):
+            yield result
+        pool.close()
+    finally:
+        # stops the workers when the import is cancelled
+        pool.terminate()
+        pool.join()
+
+def chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
 class ExcelImporter(NoteImporter):
 
     class _Data(object):
         def __init__(self, log):
+             self.workbook = None
              self.worksheet = None
              self.header = None
-             self._headerCells = None
+             self._headerValues = None
              self._log = log
              self._numFields = 0
-             self._dataDim = None
+             # number of rows up to and including the header
              self._rowOffset = 0
-             self._notes = None
+             # titles of the sheets with a header, the first is worksheet
+             self.sheetTitles = []
 
         def hasOpenWorkbook(self):
             return self.worksheet != None
 
-        def openWorkbook(self, file):
+        def openWorkbook(self, file, title=None, workbook=None):
+            """Opens the sheet of the title, or the first of SHEETS with a header,
+            of the workbook if it is given and of the file otherwise."""
             if self.hasOpenWorkbook():
                 return
-            try:
-                workbook = load_workbook(filename = file)
-            except Exception, e:
-                msg = repr(str(e))
-                raise IOError(u"<%s> not a valid Excel file: %s" % (file, msg))
+            if workbook is None:
+                try:
+                    workbook = loadWorkbook(file)
+                except Exception, e:
+                    msg = repr(str(e))
+                    raise IOError(u"<%s> not a valid Excel file: %s" % (file, msg))
+            self.workbook = workbook
             for sheet in workbook:
+                if title is not None and sheet.title != title:
+                    continue
+                if title is None and SHEETS is not None and sheet.title not in SHEETS:
+                    continue
                 self._log.append("openWorkbook: checking '%s'" % sheet.title)
                 if self.checkValidSheet(sheet):
-                    self.worksheet = sheet
-                    # TODO currently just pick the first one
-                    break
+                    self.sheetTitles.append(sheet.title)
+                    if not self.worksheet:
+                        self.worksheet = sheet
+            # the header of the first sheet is the one to map
+            if len(self.sheetTitles) > 1:
+                self.checkValidSheet(self.worksheet)
 
         def checkValidSheet(self, sheet):
-            dim = sheet.calculate_dimension()
             # TODO think about how to deal with sheets w/o header
+            # the header is the first non-empty row, unless one of the
+            # next rows has more values
+            # nothing is changed for a sheet w/o header, the sheet found
+            # before it stays the one to read
             header = None
-            self._rowOffset = 0
-            for row in tuple(sheet.iter_rows(dim)):
-                self._rowOffset += 1
-                vals = len(filter((lambda y: y.value), row))
+            rowOffset = 0
+            for i, row in enumerate(islice(sheet.iter_rows(), HEADER_SCAN_ROWS)):
+                row = rowValues(row)
+                vals = len(filter(None, row))
                 if not header and vals > 0:
                     header = row
-                elif len(filter((lambda y: y.value), header)) < vals:
+                    rowOffset = i + 1
+                elif header and len(filter(None, header)) < vals:
                     header = row
-                    break        
+                    rowOffset = i + 1
+                    break
             if header:
-                self.header = map((lambda x: str(x.value)), filter((lambda y: y.value), header))
-                self._headerCells = header
-                self._numFields = len(filter((lambda y: y.value), header))
-                self._dataDim = dim
+                self._rowOffset = rowOffset
+                # headers may be numbers or text that is not ASCII
+                self.header = map(unicode, filter(None, header))
+                self._headerValues = header
+                self._numFields = len(self.header)
                 return True
             else:
                 return False
 
-        def readData(self, mapping):
-            from anki.importing.noteimp import ForeignNote
+        def rows(self):
+            """Values of the rows below the header, streamed from the sheet.
+            Each row is as wide as the header plus one empty column, which
+            the unmapped fields are read from."""
+            width = len(self._headerValues)
+            for row in islice(self.worksheet.iter_rows(), self._rowOffset, None):
+                # read-only sheets may leave out the empty cells at the end of a row
+                row = rowValues(row)[:width]
+                yield row + (None,) * (width + 1 - len(row))
+
+        def columnPlan(self, mapping):
+            """Columns of the sheet the fields are read from, in field order.
+            The mapping has an entry for each column with a header."""
+            columns = [c for c, hdr in enumerate(self._headerValues) if hdr]
+            empty = len(self._headerValues)
+            return [c if field else empty for c, field in zip(columns, mapping)]
+
+        def mappingFor(self, fieldNames):
+            "Maps the columns to the fields named like their header."
+            return [hdr if hdr in fieldNames else None for hdr in self.header]
+
+        def readFields(self, mapping):
+            "Generates the field values of each non-empty row."
             if not self.hasOpenWorkbook():
                 self._log.append("xlimport: Error reading data: no open worksheet.")
                 return
-            assert self._dataDim
-            assert self._headerCells
-            self._notes = []
-            for row in tuple(self.worksheet.iter_rows(self._dataDim, row_offset = self._rowOffset)):
-                flds = []
-                isEmpty = True
-                for c in xrange(0, len(mapping)):
-                    hdr = self._headerCells[c].value
-                    if hdr and hdr in mapping:
-                        v = row[c].value if row[c].value else ''
-                        isEmpty = False if row[c].value else isEmpty
-                        flds.append(v if row[c].data_type == 's' else str(v))
-                if not isEmpty:
-                    note = ForeignNote()
-                    note.fields = flds
-                    self._notes.append(note)
+            assert self._headerValues
+            values = columnGetter(self.columnPlan(mapping))
+            converter = CONVERTERS.get
+            for row in self.rows():
+                vals = values(row)
+                if any(vals):
+                    # empty and zero cells give empty fields
+                    yield [converter(type(v), str)(v) if v else '' for v in vals]
+
+        def readData(self, mapping, keep=None):
+            """Generates a note for each non-empty row, and for which keep(fields)
+            is true if it is given."""
+            return makeNotes(self.readFields(mapping), keep)
 
 
     needMapper = True
@@ -97,6 +314,7 @@ class ExcelImporter(NoteImporter):
     def __init__(self, *args):
         NoteImporter.__init__(self, *args)
         self._data = None
+        self._fingerprints = None
 
     def _loadWorkbook(self):
         if not self._data:
@@ -137,10 +355,179 @@ class ExcelImporter(NoteImporter):
         return self._data._numFields
 
     def foreignNotes(self):
-        "Import."
+        "Notes of the first sheet."
         assert self.mapping
-        self._data.readData(tuple(self.mapping))
-        return self._data._notes
+        return self._data.readData(tuple(self.mapping))
+
+    def run(self):
+        """Import the notes of each sheet in batches, saving the collection
+        after each one."""
+        assert self.mapping
+        mapping = self.mapping
+        firstField = self.model['flds'][0]['name']
+        fieldNames = [f['name'] for f in self.model['flds']] + ["_tags"]
+        if INCREMENTAL:
+            self._fingerprints = RowFingerprints(self.file, self.col, self.model['id'], self.allowHTML)
+        jobs = [(self.file, title, self._data.header, mapping, fieldNames)
+                for title in self._data.sheetTitles]
+        total = 0
+        rows = 0
+        cancelled = False
+        # first fields of the rows so far, in all batches and sheets
+        seen = set()
+        self._startBatches()
+        sheets = parseSheets(jobs, workbook = self._data.workbook)
+        try:
+            for title, sheetMapping, fieldRows in sheets:
+                self.mapping = sheetMapping
+                if firstField not in self.mapping:
+                    self.log.append("Sheet '%s' has no column for the %s field, skipped." % (title, firstField))
+                    continue
+                keyIndex = self.mapping.index(firstField)
+                fieldRows = self._firstOccurrences(fieldRows, keyIndex, seen)
+                keep = None
+                if self._fingerprints:
+                    keep = self._fingerprints.keep(title, self.mapping, keyIndex)
+                for notes in chunks(makeNotes(fieldRows, keep), BATCH_SIZE):
+                    # the first fields repeated in the workbook are left out
+                    # already, the rest are checked against the collection
+                    self._importBatch(notes)
+                    total += self.total
+                    rows += len(notes)
+                    self.col.save()
+                    if self._fingerprints:
+                        self._fingerprints.commit()
+                    mw.progress.update(label = "Imported %d rows..." % rows)
+                    if self._wantCancel():
+                        self.log.append("Import cancelled after %d rows." % rows)
+                        cancelled = True
+                        break
+                if cancelled:
+                    break
+        finally:
+            sheets.close()
+            self.mapping = mapping
+        self._finishBatches()
+        self.total = total
+        if self._fingerprints:
+            self._fingerprints.save(self.log)
+            self.log.append("%d rows unchanged and skipped, %d updated, %d added." % (
+                self._fingerprints.skipped, self._fingerprints.updated, self._fingerprints.added))
+
+    def _firstOccurrences(self, rows, keyIndex, seen):
+        """Leaves out the rows whose first field appeared before, as
+        importNotes does, so that the first row wins whatever the batch
+        size."""
+        for flds in rows:
+            key = noteField(flds[keyIndex], self.allowHTML)
+            if key and self.importMode != 2:
+                if key in seen:
+                    self.log.append("Appeared twice in file: %s" % key)
+                    continue
+                seen.add(key)
+            yield flds
+
+    def _startBatches(self):
+        """importNotes split in batches: the notes of the model are read once
+        for all of them, as they were before the import like in a single
+        importNotes call, and the counts are kept until _finishBatches."""
+        self._csums = {}
+        for csum, id in self.col.db.execute(
+            "select csum, id from notes where mid = ?", self.model['id']):
+            self._csums.setdefault(csum, []).append(id)
+        self._fmap = self.col.models.fieldMap(self.model)
+        self._dupes = set()
+        self._updateLog = []
+        self._emptyNotes = False
+        self._emptyCards = False
+        self._added = self._updated = self._dupeCount = 0
+
+    def _importBatch(self, notes):
+        "Adds or updates the notes like importNotes, but the deck is ordered later."
+        assert self.mappingOk()
+        self._tagsMapped = "_tags" in self.mapping
+        fld0idx = self.mapping.index(self.model['flds'][0]['name'])
+        self._nextID = anki.utils.timestampID(self.col.db, "notes")
+        self._ids = []
+        self._cards = []
+        new = []
+        updates = []
+        for n in notes:
+            n.fields = [noteField(text, self.allowHTML) for text in n.fields]
+            fld0 = n.fields[fld0idx]
+            if not fld0:
+                self.log.append(_("Empty first field: %s") % " ".join(n.fields))
+                continue
+            csum = anki.utils.fieldChecksum(fld0)
+            found = False
+            # the checksum is not a guarantee, the field has to be compared
+            for id in self._csums.get(csum, ()):
+                sflds = anki.utils.splitFields(
+                    self.col.db.scalar("select flds from notes where id = ?", id))
+                if fld0 != sflds[0]:
+                    continue
+                if self.importMode == 0:
+                    data = self.updateData(n, id, sflds)
+                    if data:
+                        updates.append(data)
+                        self._updateLog.append(_("First field matched: %s") % fld0)
+                    self._dupeCount += 1
+                    found = True
+                elif self.importMode == 1:
+                    self._dupeCount += 1
+                    found = True
+                elif fld0 not in self._dupes:
+                    # duplicates are added, the message is only shown once
+                    self._updateLog.append(_("Added duplicate with first field: %s") % fld0)
+                    self._dupes.add(fld0)
+                break
+            if not found:
+                data = self.newData(n)
+                if data:
+                    new.append(data)
+        self.addNew(new)
+        self.addUpdates(updates)
+        self.col.updateFieldCache(self._ids)
+        if self.col.genCards(self._ids):
+            self._emptyCards = True
+        self.updateCards()
+        self._added += len(new)
+        self._updated += self.updateCount
+        self.total = len(self._ids)
+
+    def _finishBatches(self):
+        "Orders the new cards of the deck and logs the counts of all batches."
+        # siblings get the same due when the cards are ordered after they
+        # are all added
+        did = self.col.decks.selected()
+        conf = self.col.decks.confForDid(did)
+        if conf['new']['order'] == NEW_CARDS_RANDOM:
+            self.col.sched.randomizeCards(did)
+        else:
+            self.col.sched.orderCards(did)
+        if self._emptyCards:
+            self.log.insert(0, _("Empty cards found. Please run Tools>Empty Cards."))
+        if self.importMode == 0:
+            unchanged = self._dupeCount - self._updated
+        elif self.importMode == 1:
+            unchanged = self._dupeCount
+        else:
+            unchanged = 0
+        part1 = ngettext("%d note added", "%d notes added", self._added) % self._added
+        part2 = ngettext("%d note updated", "%d notes updated", self._updated) % self._updated
+        part3 = ngettext("%d note unchanged", "%d notes unchanged", unchanged) % unchanged
+        self.log.append("%s, %s, %s." % (part1, part2, part3))
+        self.log.extend(self._updateLog)
+        if self._emptyNotes:
+            self.log.append(_(
+                "One or more notes were not imported, because they didn't generate any cards. "
+                "This can happen when you have empty fields or when you have not mapped the "
+                "content in the text file to the correct fields."))
+
+    def _wantCancel(self):
+        # set by the progress window when the user closes it, in the
+        # versions of Anki that support it
+        return getattr(getattr(mw.progress, '_win', None), 'wantCancel', False)
 
     def initMapping(self):
         self._chooseLikelyModel()
@@ -0,0 +1,82 @@
+# Benchmarks for the Excel importer, not part of the add-on. To run them, copy this file
+# next to xlimport.py, where Anki loads it at startup like any add-on (it only defines
+# functions), and call them from the Anki debug console, e.g.
+#   import xlimport_bench; xlimport_bench.readData()
+
+import os
+import time
+import random
+import datetime
+import tempfile
+
+from openpyxl import Workbook
+
+import xlimport
+
+HEADER = ['Front', 'Back', 'Reading', 'Level', 'Added', 'Notes']
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def makeWorkbook(path, rows=100000, sheets=1):
+    "Writes a workbook of vocabulary-like rows with strings, numbers and dates."
+    rng = random.Random(0)
+    workbook = Workbook(write_only = True)
+    for s in xrange(sheets):
+        sheet = workbook.create_sheet(title = 'Sheet %d' % (s + 1))
+        sheet.append(HEADER)
+        for i in xrange(rows):
+            sheet.append([u'word %d' % i, u'meaning of word %d' % i, u'reading %d' % i,
+                          rng.randint(1, 5), datetime.datetime(2019, 1, 1) + datetime.timedelta(i % 365),
+                          None if i % 3 else u'note %d' % i])
+    workbook.save(path)
+
+def perCell(data, mapping):
+    # the per-row and per-column loop that readData used before the column plan
+    count = 0
+    for row in data.rows():
+        flds = []
+        isEmpty = True
+        for c in xrange(0, len(mapping)):
+            hdr = data._headerValues[c]
+            if hdr and hdr in mapping:
+                v = row[c] if row[c] else ''
+                isEmpty = False if row[c] else isEmpty
+                flds.append(v if isinstance(v, basestring) else str(v))
+        if not isEmpty:
+            count += 1
+    return count
+
+def readData(rows=100000, path=None):
+    "Compares streaming the rows alone with converting them cell by cell and with the column plan."
+    path = path or os.path.join(tempfile.gettempdir(), 'xlimport-bench.xlsx')
+    if not os.path.exists(path):
+        makeWorkbook(path, rows)
+    data = xlimport.ExcelImporter._Data([])
+    data.openWorkbook(path)
+    mapping = tuple(HEADER)
+    streamTime, count = timed(lambda: sum(1 for row in data.rows()))
+    perCellTime = timed(perCell, data, mapping)[0]
+    planTime = timed(lambda: sum(1 for note in data.readData(mapping)))[0]
+    print "%d rows" % count
+    print "streaming rows: %.2f s" % streamTime
+    print "per-cell loop: %.2f s" % perCellTime
+    print "column plan: %.2f s" % planTime
+
+def sheets(count=20, rows=5000, path=None, processes=None):
+    "Compares parsing the sheets of a workbook one after another and in worker processes."
+    path = path or os.path.join(tempfile.gettempdir(), 'xlimport-bench-%d.xlsx' % count)
+    if not os.path.exists(path):
+        makeWorkbook(path, rows, count)
+    data = xlimport.ExcelImporter._Data([])
+    data.openWorkbook(path)
+    jobs = [(path, title, data.header, data.header, HEADER) for title in data.sheetTitles]
+    def parse(processes):
+        return sum(len(list(fieldRows)) for title, mapping, fieldRows in xlimport.parseSheets(jobs, processes))
+    sequentialTime, total = timed(parse, 1)
+    parallelTime = timed(parse, processes)[0]
+    print "%d rows in %d sheets" % (total, len(jobs))
+    print "sequential: %.2f s" % sequentialTime
+    print "worker processes: %.2f s" % parallelTime
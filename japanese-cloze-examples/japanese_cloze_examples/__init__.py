@@ -11,25 +11,110 @@
 # License: GNU AGPL
 
 
-from aqt.qt import QHBoxLayout, QLineEdit, QRect, QDialog, QListWidgetItem, QSize, QStyledItemDelegate, QTextDocument
-from aqt.qt import QStyleOptionViewItemV4, QAbstractTextDocumentLayout, QStyle, QApplication
+import time
+# Taken before the other imports, which are part of the cost of loading the add-on
+importStarted = time.time()
+
+import sys
+import threading
+
+from aqt.qt import QHBoxLayout, QLineEdit, QRect, QDialog, QSize, QStyledItemDelegate, QTextDocument
+from aqt.qt import QStyleOptionViewItemV4, QAbstractTextDocumentLayout, QStyle, QApplication, QAction, SIGNAL
+from aqt.qt import QCompleter, QStringListModel, QProgressDialog, Qt, QObject, QTimer, pyqtSignal
+from aqt.qt import QListView, QAbstractListModel, QModelIndex
+from aqt import mw
 from aqt.browser import Browser
 from aqt.editor import Editor
-from aqt.utils import showInfo, askUser
+from aqt.utils import showInfo, askUser, tooltip
 
 from anki.utils import isMac
 from anki.hooks import wrap as wrapHook, addHook
 from anki.lang import _
 
-from card import installJapaneseSupport, FieldGenerator, MODELNAME
+from card import installJapaneseSupport, FieldGenerator, ReadingGenerator, BatchReadingGenerator, prerenderNotes
+from card import MODELNAME, FURIGANAFIELD
 from forms.selectdialog import Ui_selectDialog
-from search import Dictionary
+from search import Dictionaries, QUERY_SEPARATOR, corpusPaths, isIndexed
+from cache import LRUCache
+
+
+# Refresh the open list of examples while the expression is being typed
+SEARCH_AS_YOU_TYPE = False
+# Milliseconds without typing before the search starts
+SEARCH_DELAY = 300
+# Number of examples added to the list at a time
+PAGE_SIZE = 25
+# Number of laid out examples kept by the list
+DOCUMENT_CACHE_SIZE = 256
+# Open the corpora shortly after the profile is loaded, instead of on the first search, if their
+# indexes do not need to be built
+WARMUP = True
+# Milliseconds after the profile is loaded, or after Anki was found busy, before the corpora are opened
+WARMUP_DELAY = 3000
+
+# Milliseconds spent importing the add-on ("import") and opening the corpora ("load")
+timings = {}
+
+
+# Runs the searches in a worker thread, one at a time. A new request replaces the one waiting,
+# and the results of a request which is not the latest are dropped.
+class Searcher(QObject):
+    
+    # Request id and (cursor, questions, answers) of the first page, delivered on the main thread
+    searched = pyqtSignal(int, object)
+    # Request id and sys.exc_info() of a search which raised, delivered on the main thread
+    failed = pyqtSignal(int, object)
+    
+    def __init__(self, dictionary):
+        QObject.__init__(self)
+        self.dictionary = dictionary
+        self.requestId = 0
+        self.pending = None
+        self.condition = threading.Condition()
+        thread = threading.Thread(target=self.work)
+        thread.daemon = True
+        thread.start()
+        
+    def search(self, expression):
+        # Returns the id of the request
+        with self.condition:
+            self.requestId += 1
+            self.pending = (self.requestId, expression)
+            self.condition.notify()
+            return self.requestId
+    
+    def work(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                requestId, expression = self.pending
+                self.pending = None
+            try:
+                cursor = self.dictionary.cursor(expression)
+                results = (cursor,) + cursor.fetch(PAGE_SIZE)
+            except Exception:
+                if requestId == self.requestId:
+                    self.failed.emit(requestId, sys.exc_info())
+                continue
+            if requestId == self.requestId:
+                self.searched.emit(requestId, results)
 
 
 class Toolbar(object):
     
     def __init__(self):
-            self.dictionary = Dictionary()
+            # The corpora are opened on first use, see loadDictionary
+            self.dictionary = None
+            self.searcher = None
+            self.searchId = None
+            self.searchExpression = None
+            
+            # Searches as you type once the typing stops for SEARCH_DELAY
+            self.typingTimer = QTimer()
+            self.typingTimer.setSingleShot(True)
+            self.typingTimer.setInterval(SEARCH_DELAY)
+            mw.connect(self.typingTimer, SIGNAL("timeout()"), self.searchAsYouType)
             
             def onSetNote(editor, note, hide = True, focus = False):
                 # Hides the toolbar when editing different models than MODELNAME 
@@ -46,6 +131,44 @@ class Toolbar(object):
             
             # Setup the toolbar when the editor is being set up        
             addHook("setupEditorButtons", self.addToolbar)
+            
+            # Allow rebuilding the index after the corpus was replaced
+            action = QAction(_(u"Rebuild Japanese Cloze Examples Index"), mw)
+            mw.connect(action, SIGNAL("triggered()"), self.rebuildIndex)
+            mw.form.menuTools.addAction(action)
+            
+            # Store the cloze highlighting of the existing notes, so their cards render without MeCab
+            action = QAction(_(u"Prerender Japanese Cloze Highlighting"), mw)
+            mw.connect(action, SIGNAL("triggered()"), self.prerenderNotes)
+            mw.form.menuTools.addAction(action)
+            
+            # Allow filling the furigana of the notes selected in the Browser
+            addHook("browser.setupMenus", self.addBrowserMenu)
+            
+            if WARMUP:
+                addHook("profileLoaded", lambda: QTimer.singleShot(WARMUP_DELAY, self.warmup))
+    
+    def warmup(self):
+        # Opens the corpora once Anki is not busy, if their indexes are up to date. A build is left
+        # to the first search, as it shows a progress window.
+        if self.dictionary is not None or not all(isIndexed(path) for path in corpusPaths()):
+            return
+        if mw.progress.busy():
+            QTimer.singleShot(WARMUP_DELAY, self.warmup)
+            return
+        self.loadDictionary()
+    
+    def loadDictionary(self):
+        # Opens the corpora, building their indexes if needed. Runs on the main thread,
+        # as a build shows its progress.
+        if self.dictionary is None:
+            started = time.time()
+            self.dictionary = Dictionaries()
+            self.searcher = Searcher(self.dictionary)
+            self.searcher.searched.connect(self.onSearched)
+            self.searcher.failed.connect(self.onSearchFailed)
+            timings["load"] = (time.time() - started) * 1000
+        return self.dictionary
         
     def addToolbar(self, editor):
             self.editor = editor            
@@ -68,6 +191,16 @@ class Toolbar(object):
                 self.editor.searchLine.setObjectName(u"searchLine")
                 self.editor.iconsBox.addWidget(self.editor.searchLine)
                 
+                # Suggest the dictionary keys matching what is being typed
+                self.editor.searchCompleter = QCompleter(self.editor.searchLine)
+                self.editor.searchCompleter.setModel(QStringListModel(self.editor.searchCompleter))
+                self.editor.searchCompleter.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+                self.editor.searchCompleter.setWidget(self.editor.searchLine)
+                self.editor.searchLine.connect(self.editor.searchLine, SIGNAL("textEdited(QString)"), self.suggestKeys)
+                self.editor.searchCompleter.connect(self.editor.searchCompleter, SIGNAL("activated(QString)"), self.editor.searchLine.setText)
+                if SEARCH_AS_YOU_TYPE:
+                    self.editor.searchLine.connect(self.editor.searchLine, SIGNAL("textEdited(QString)"), lambda text: self.typingTimer.start())
+                
                 self.editor.search = self.editor._addButton("search", lambda: self.openSelectDialog(self.editor.searchLine.text()), tip=_(u"Search for an example sentence for the expression"), text=_(u"Search"), size=False, native=True, canDisable=False)
 
         
@@ -75,14 +208,125 @@ class Toolbar(object):
         if not expression:
             showInfo(_("Enter a Japanese word to look up an example sentence for."))       
         else:
-            # Open the select dialog the there are examples for the searched expression
-            if self.dictionary.findExamples(expression)[0]:
-                self.editor.dialog = SelectDialog(self, expression)
-                self.editor.dialog.show()
+            # The dialog is opened once the examples are found, the editor stays responsive meanwhile
+            self.typingTimer.stop()
+            self.searchExpression = expression
+            self.loadDictionary()
+            self.searchId = self.searcher.search(expression)
+    
+    def searchAsYouType(self):
+        # Only refreshes a list which is already open, opening one would take the focus away
+        dialog = getattr(self.editor, "dialog", None)
+        expression = self.editor.searchLine.text()
+        if dialog is not None and dialog.isVisible() and expression:
+            self.searchExpression = None
+            self.searchId = self.searcher.search(expression)
+    
+    def onSearchFailed(self, requestId, excInfo):
+        # Raised again on the main thread, where Anki reports it
+        if requestId != self.searchId:
+            return
+        self.searchId = None
+        raise excInfo[0], excInfo[1], excInfo[2]
+    
+    def onSearched(self, requestId, results):
+        if requestId != self.searchId:
+            return
+        self.searchId = None
+        if self.searchExpression is None:
+            # Search as you type
+            self.editor.dialog.setResults(results)
+            return
+        expression = self.searchExpression
+        # Open the select dialog the there are examples for the searched expression
+        if results[1]:
+            self.editor.dialog = SelectDialog(self, expression, results)
+            self.editor.dialog.show()
+        else:
+            # If the expression is not in the corpus, offer search on ALC
+            if askUser(_(u"No examples found.\nDo you want to search ALC for the expression?")):
+                self.searchAlc(expression)
+    
+    def suggestKeys(self, text):
+        # Only the last term of a query is completed
+        term = QUERY_SEPARATOR.split(text)[-1].lstrip(u"-")
+        head = text[:len(text) - len(term)]
+        keys = [head + key for key in self.loadDictionary().matchKeys(term)]
+        self.editor.searchCompleter.model().setStringList(keys)
+        if keys:
+            self.editor.searchCompleter.complete()
+        else:
+            self.editor.searchCompleter.popup().hide()
+    
+    def rebuildIndex(self):
+        # The current index keeps answering searches while the new one is built
+        def onDone(success):
+            if success:
+                tooltip(_(u"The example sentence index was rebuilt."))
             else:
-                # If the expression is not in the corpus, offer search on ALC
-                if askUser(_(u"No examples found.\nDo you want to search ALC for the expression?")):
-                    self.searchAlc(expression)
+                showInfo(_(u"The example sentence index could not be rebuilt."))
+        if self.loadDictionary().rebuild(background=True, onDone=onDone):
+            tooltip(_(u"Rebuilding the example sentence index..."))
+        else:
+            tooltip(_(u"The example sentence index is being rebuilt already."))
+    
+    def prerenderNotes(self):
+        if not ReadingGenerator().japaneseSupportExists():
+            return
+        tooltip(_(u"Stored the cloze highlighting of %d notes.") % prerenderNotes())
+    
+    def addBrowserMenu(self, browser):
+        action = QAction(_(u"Generate Japanese Cloze Furigana"), browser)
+        browser.connect(action, SIGNAL("triggered()"), lambda: self.generateFurigana(browser))
+        browser.form.menuEdit.addSeparator()
+        browser.form.menuEdit.addAction(action)
+    
+    def generateFurigana(self, browser):
+        # MeCab runs in another thread, the notes are only touched on the main thread
+        nids = browser.selectedNotes()
+        if not nids:
+            showInfo(_(u"Select the notes to generate the furigana for."))
+            return
+        if not ReadingGenerator().japaneseSupportExists():
+            return
+        generator = BatchReadingGenerator(nids)
+        if not generator.notes:
+            tooltip(_(u"None of the selected notes has an empty %s field.") % FURIGANAFIELD)
+            return
+        
+        dialog = QProgressDialog(_(u"Generating furigana..."), _(u"Cancel"), 0, len(generator.notes), browser)
+        dialog.setWindowModality(Qt.WindowModal)
+        dialog.setMinimumDuration(0)
+        cancelled = threading.Event()
+        browser.connect(dialog, SIGNAL("canceled()"), cancelled.set)
+        done = [0]
+        result = []
+        def run():
+            try:
+                generator.run(lambda count: done.__setitem__(0, count), cancelled.is_set)
+                result.append(None)
+            except Exception, e:
+                result.append(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        
+        def poll():
+            dialog.setValue(done[0])
+            if thread.is_alive():
+                return
+            timer.stop()
+            dialog.close()
+            # Whatever was generated before a cancel or an error is kept
+            browser.model.beginReset()
+            count = generator.save()
+            browser.model.endReset()
+            mw.requireReset()
+            if result[0] is not None:
+                showInfo(_(u"Generating the furigana failed: %s") % result[0])
+            else:
+                tooltip(_(u"Generated furigana for %d notes.") % count)
+        timer = mw.progress.timer(100, poll, True)
     
     def searchAlc(self, expression):
         # Uses Japanese Support addon to look the word up on ALC, if it's not installed, asks to download it.
@@ -94,44 +338,45 @@ class Toolbar(object):
 
 #Initiate the toolbar
 toolbar = Toolbar()
+timings["import"] = (time.time() - importStarted) * 1000
                         
 
 class SelectDialog(QDialog):
 
-    def __init__(self, toolbar, expression):        
+    def __init__(self, toolbar, expression, results=None):        
         QDialog.__init__(self)
         self.selectDialog = Ui_selectDialog()
         self.selectDialog.setupUi(self)
         
-        self.dictionary = toolbar.dictionary
+        self.dictionary = toolbar.loadDictionary()
         self.editor = toolbar.editor
         
         # Using custom delegate to render sentences in color
-        self.itemDelegate = HTMLDelegate()
-        self.selectDialog.listWidget.setItemDelegate(self.itemDelegate)
+        self.itemDelegate = HTMLDelegate(self)
+        self.selectDialog.listView.setItemDelegate(self.itemDelegate)
+        # Rows are laid out a batch at a time, so a long list does not block the dialog
+        self.selectDialog.listView.setLayoutMode(QListView.Batched)
+        self.selectDialog.listView.setBatchSize(PAGE_SIZE)
+        self.model = ExampleModel(self)
+        self.selectDialog.listView.setModel(self.model)
         
-        # Find examples and list them
-        self.resultsJapanese, self.resultsEnglish = self.dictionary.findExamples(expression)        
-        for sentence in self.resultsJapanese:
-            item = QListWidgetItem()
-            item.setText(sentence)
-            self.selectDialog.listWidget.addItem(item)
+        # Find examples and list them, unless they were found already
+        if results is None:
+            cursor = self.dictionary.cursor(expression)
+            results = (cursor,) + cursor.fetch(PAGE_SIZE)
+        self.setResults(results)
+    
+    def setResults(self, results):
+        # The cursor and the questions and answers of its first page
+        self.model.setExamples(*results)
             
     def accept(self):       
-        exampleEnglish = None
-        
         # Return the selected example
-        try:        
-            exampleJapanese = self.selectDialog.listWidget.selectedItems()[0].text()
-        except Exception:  
-                showInfo(_(u"Choose an example sentence"))
-                return
-        exampleJapanese = self.selectDialog.listWidget.currentItem().text()
-            
-        # Find the English translation for the selected example
-        for sentence in self.resultsJapanese:
-            if exampleJapanese == sentence:
-                exampleEnglish = self.resultsEnglish[self.resultsJapanese.index(sentence)]
+        index = self.selectDialog.listView.currentIndex()
+        if not index.isValid() or not self.selectDialog.listView.selectionModel().isSelected(index):
+            showInfo(_(u"Choose an example sentence"))
+            return
+        exampleJapanese, exampleEnglish = self.model.example(index.row())
         
         # Generate card from the examples and set the focus on the first field
         if FieldGenerator(self.editor.note).generateFields(exampleJapanese, exampleEnglish):
@@ -143,8 +388,66 @@ class SelectDialog(QDialog):
         self.close()
 
 
+# The found examples, of which the next PAGE_SIZE are fetched from the cursor whenever the view
+# scrolls to the end
+class ExampleModel(QAbstractListModel):
+    
+    def __init__(self, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self.cursor = None
+        self.questions = []
+        self.answers = []
+    
+    def setExamples(self, cursor, questions, answers):
+        self.beginResetModel()
+        self.cursor = cursor
+        self.questions = list(questions)
+        self.answers = list(answers)
+        self.endResetModel()
+    
+    def example(self, row):
+        # The Japanese and English sentence of the row
+        return self.questions[row], self.answers[row]
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.questions)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.questions[index.row()]
+        return None
+    
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.cursor is not None and not self.cursor.exhausted
+    
+    def fetchMore(self, parent):
+        questions, answers = self.cursor.fetch(PAGE_SIZE)
+        if not questions:
+            return
+        first = len(self.questions)
+        self.beginInsertRows(QModelIndex(), first, first + len(questions) - 1)
+        self.questions.extend(questions)
+        self.answers.extend(answers)
+        self.endInsertRows()
+
+
 class HTMLDelegate(QStyledItemDelegate):
     
+    def __init__(self, parent=None):
+        QStyledItemDelegate.__init__(self, parent)
+        # Laid out documents by (text, width), dropped when the view is painted at another width
+        self.documents = LRUCache(DOCUMENT_CACHE_SIZE)
+        self.width = None
+    
+    def document(self, text, width):
+        doc = self.documents.get((text, width))
+        if doc is None:
+            doc = QTextDocument()
+            doc.setHtml(text)
+            doc.setTextWidth(width)
+            self.documents[(text, width)] = doc
+        return doc
+    
     def paint(self, painter, option, index):
         options = QStyleOptionViewItemV4(option)
         self.initStyleOption(options,index)
@@ -152,10 +455,14 @@ class HTMLDelegate(QStyledItemDelegate):
         # Choose appropriate style
         style = QApplication.style() if options.widget is None else options.widget.style()
 
+        # A resized view lays out its documents again, those of the old width are not shown anymore
+        width = option.rect.width()
+        if width != self.width:
+            self.documents.clear()
+            self.width = width
+
         # Convert text into HTML
-        doc = QTextDocument()
-        doc.setHtml(options.text)
-        doc.setTextWidth(option.rect.width())
+        doc = self.document(options.text, width)
 
         options.text = ""
         style.drawControl(QStyle.CE_ItemViewItem, options, painter);
@@ -175,7 +482,5 @@ class HTMLDelegate(QStyledItemDelegate):
         self.initStyleOption(options,index)
 
         # Get sizeof the elements
-        doc = QTextDocument()
-        doc.setHtml(options.text)
-        doc.setTextWidth(options.rect.width())
-        return QSize(doc.idealWidth(), doc.size().height())
\ No newline at end of file
+        doc = self.document(options.text, options.rect.width())
+        return QSize(doc.idealWidth(), doc.size().height())
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+#
+# Description: Gives a list of example sentences from Tanaka Corpus for the searched expression
+# and generates a cloze card for the chosen sentence, complete with furigana. Generates furigana for custom sentences as well.
+# This addon is based on Guillaume VIRY's example sentences plugin for Anki and some code from Pyry KONTIO's Cloze Furigana Tools.
+# Version 1.0, released 2014-07-20
+#
+# Author: Radek SPRTA
+# Email: radek.sprta@gmail.com
+# License: GNU AGPL
+
+# Benchmarks for the example search. Run them from the Anki debug console, e.g.
+#   from japanese_cloze_examples import bench; bench.build()
+
+import os
+import time
+import random
+
+import codecs
+
+import search
+from index import writeIndex
+from reading import mecabService
+
+
+COMMON_WORDS = [u"する", u"ある", u"いる", u"なる", u"言う", u"行く", u"見る", u"来る", u"思う", u"食べる",
+                u"人", u"日本", u"時", u"事", u"彼", u"私", u"学校", u"本", u"猫", u"今日"]
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def startup():
+    # What loading the add-on cost when Anki started, and opening the corpora afterwards
+    import japanese_cloze_examples
+    timings = japanese_cloze_examples.timings
+    print "import: %.0f ms" % timings["import"]
+    if "load" in timings:
+        print "load: %.0f ms" % timings["load"]
+    else:
+        print "load: the corpora are not open yet"
+    elapsed, dictionaries = timed(search.Dictionaries)
+    dictionaries.close()
+    print "open again: %.0f ms" % (elapsed * 1000)
+
+
+def build(dictionary=None):
+    # Compares building the whole dictionary in memory with the streaming index builder
+    dictionary = dictionary or search.Dictionary()
+    path = dictionary.indexPath + ".bench"
+
+    def inMemory():
+        dictionary.dictionary = {}
+        dictionary.buildDictionary()
+        writeIndex(path, dictionary.path, dictionary.dictionary)
+
+    def streaming():
+        writer = dictionary.buildIndex()
+        os.remove(writer.tmpPath)
+
+    original = dictionary.dictionary
+    try:
+        inMemoryTime = timed(inMemory)[0]
+        streamingTime = timed(streaming)[0]
+    finally:
+        dictionary.dictionary = original
+        if os.path.exists(path):
+            os.remove(path)
+    print "in-memory build: %.2f s" % inMemoryTime
+    print "streaming build: %.2f s" % streamingTime
+
+
+def findExamples(dictionary=None, words=COMMON_WORDS, repeat=20):
+    # Average time of a search for each of the words, bypassing the result cache
+    dictionary = dictionary or search.Dictionary()
+    def run():
+        for i in xrange(repeat):
+            for word in words:
+                dictionary.searchExamples(word, random)
+    elapsed = timed(run)[0]
+    print "findExamples: %.2f ms per search" % (elapsed * 1000 / (repeat * len(words)))
+
+
+def latency(dictionary=None, words=None, repeat=5):
+    # Median and 99th percentile of the uncached search time over the words, all indexed words by default
+    dictionary = dictionary or search.Dictionary()
+    words = words or list(dictionary.dictionary)
+    times = []
+    for i in xrange(repeat):
+        for word in words:
+            times.append(timed(dictionary.searchExamples, word, random)[0])
+    times.sort()
+    print "findExamples (%s): p50 %.3f ms, p99 %.3f ms" % (
+        "spans" if getattr(dictionary.dictionary, "hasSpans", False) else "regex",
+        times[len(times) // 2] * 1000, times[len(times) * 99 // 100] * 1000)
+
+
+def readings(sentences, repeat=3):
+    # Readings per second, one sentence per MeCab round trip and pipelined in batches
+    service = mecabService()
+    service.reading(sentences[0])
+    single = timed(lambda: [service.reading(sentence) for i in xrange(repeat) for sentence in sentences])[0]
+    batch = timed(lambda: [service.readings(sentences) for i in xrange(repeat)])[0]
+    count = repeat * len(sentences)
+    print "readings: %.0f/s one at a time, %.0f/s in batches" % (count / single, count / batch)
+
+
+def recordReadings(sentences, path):
+    # Saves the readings of the sentences as a golden file for checkReadings
+    f = codecs.open(path, 'w', 'utf8')
+    for sentence, reading in zip(sentences, mecabService().readings(sentences)):
+        f.write(u"%s\t%s\n" % (sentence, reading))
+    f.close()
+
+
+def checkReadings(path):
+    # Compares the readings with a golden file written by recordReadings
+    f = codecs.open(path, 'r', 'utf8')
+    golden = [line.rstrip(u"\n").split(u"\t") for line in f]
+    f.close()
+    readings = mecabService().readings([sentence for sentence, reading in golden])
+    mismatches = [(sentence, reading, actual) for (sentence, reading), actual in zip(golden, readings) if reading != actual]
+    for sentence, reading, actual in mismatches[:10]:
+        print (u"%s: expected %s, got %s" % (sentence, reading, actual)).encode('utf8')
+    print "readings: %d of %d differ from %s" % (len(mismatches), len(golden), path)
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+#
+# Description: Gives a list of example sentences from Tanaka Corpus for the searched expression
+# and generates a cloze card for the chosen sentence, complete with furigana. Generates furigana for custom sentences as well.
+# This addon is based on Guillaume VIRY's example sentences plugin for Anki and some code from Pyry KONTIO's Cloze Furigana Tools.
+# Version 1.0, released 2014-07-20
+#
+# Author: Radek SPRTA
+# Email: radek.sprta@gmail.com
+# License: GNU AGPL
+
+import sqlite3
+from collections import OrderedDict
+
+
+# Dictionary which forgets the least recently used items once it holds more than size of them.
+# Counts the hits and misses of get().
+class LRUCache():
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+
+# LRUCache of unicode strings backed by an SQLite file, so what is cached survives a restart.
+# The file keeps about the diskSize most recently added items; if it cannot be used, the cache
+# works from memory only.
+class PersistentCache(LRUCache):
+
+    def __init__(self, path, size, diskSize):
+        LRUCache.__init__(self, size)
+        self.diskSize = diskSize
+        self.added = 0
+        try:
+            self.db = sqlite3.connect(path)
+            self.db.execute("create table if not exists cache (key text primary key, value text not null)")
+            self.db.commit()
+        except sqlite3.Error:
+            self.db = None
+
+    def get(self, key, default=None):
+        value = LRUCache.get(self, key)
+        if value is None and self.db is not None:
+            try:
+                row = self.db.execute("select value from cache where key = ?", (key,)).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row:
+                value = row[0]
+                LRUCache.__setitem__(self, key, value)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+
+    def update(self, items):
+        # Adds the (key, value) pairs, writing them to the file in one transaction
+        for key, value in items:
+            LRUCache.__setitem__(self, key, value)
+        if self.db is None:
+            return
+        try:
+            self.db.executemany("insert or replace into cache (key, value) values (?, ?)", items)
+            # Trimming the file every time would cost a scan per insert
+            if self.added // 100 != (self.added + len(items)) // 100:
+                self.db.execute("delete from cache where rowid <= (select max(rowid) from cache) - ?",
+                                (self.diskSize,))
+            self.added += len(items)
+            self.db.commit()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
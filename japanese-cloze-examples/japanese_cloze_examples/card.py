@@ -11,15 +11,22 @@
 # License: GNU AGPL
 
 import re 
+import os
+import json
+import hashlib
 
 from aqt import mw
 from aqt.utils import showInfo, askUser
 
 from anki.lang import _
 from anki.hooks import addHook
+from anki.utils import splitFields
 import anki.stdmodels
 from anki.template.furigana import furigana as furiganaToRuby
 
+from cache import LRUCache, PersistentCache
+from reading import mecabService, BATCH_SIZE
+
 
 JAPANESESUPPORTCODE = "3918629684"
 # You can change the field names here
@@ -42,6 +49,22 @@ MODELQUESTION = "\
 {{Extra}}"
 MODELANSWER = "<span class=jp>{{furigana:Furigana}}</span><br><br>\
                 {{Extra}}"
+# Readings of the cloze fields are kept so reviewing a card seen before needs no MeCab call
+READING_CACHE = os.path.join(mw.pm.addonFolder(), "japanese_cloze_examples.readings")
+# Number of readings kept in memory and in the cache file
+READING_CACHE_SIZE = 512
+READING_CACHE_DISK_SIZE = 20000
+# Styles given word as cloze
+CLOZESTYLE = "<span class=cloze>%s</span>"
+FURIGANABRACKETS = re.compile(r"\[(.*?)\]")
+CLOZEORDINALS = re.compile(r"\{\{c(\d+)::")
+# Number of note and cloze pairs whose rubies are kept
+CLOZE_CACHE_SIZE = 256
+# Store the rubies of every cloze in the note's data when the fields are generated,
+# so rendering a card is a lookup only
+PRERENDER = True
+# Key of the stored rubies in the note's data
+DATAKEY = "japaneseClozeExamples"
 
 
 def addJapaneseClozeModel(col):
@@ -102,6 +125,7 @@ class FieldGenerator():
             return False
         if not self.addReading(exampleJapanese) or not self.addExamples(exampleJapanese, exampleEnglish):
             return False
+        storeClozes(self.note)
         return True
 
     def canSave(self, fields=[CLOZEFIELD, ENGLISHFIELD, FURIGANAFIELD], canOverride=True):
@@ -179,10 +203,7 @@ class FieldGenerator():
             return flag
             
         # Grab the source text
-        source = mw.col.media.strip(note[CLOZEFIELD])
-        # Remove the cloze brackets
-        source = source.replace("}}","")
-        source = re.sub(r"\{\{c\d+::", "", source)
+        source = clozeText(note[CLOZEFIELD])
         if not source:
             return flag
         # Generate the reading and add it to the field
@@ -191,7 +212,55 @@ class FieldGenerator():
         except Exception, e:
             self.mecab = None
             raise e
+        storeClozes(note)
+        return True
+        
+
+def clozeText(cloze):
+    # The sentence of a cloze field without media and cloze brackets
+    source = mw.col.media.strip(cloze)
+    source = source.replace("}}","")
+    return re.sub(r"\{\{c\d+::", "", source)
+
+
+# Fills the empty Furigana fields of many notes at once. The notes are read and saved on the main thread,
+# the readings are generated by run(), which may be called from another thread.
+class BatchReadingGenerator():
+
+    def __init__(self, nids):
+        self.notes = []
+        self.sources = []
+        self.readings = []
+        for nid in nids:
+            note = mw.col.getNote(nid)
+            if MODELNAME.lower() not in note.model()['name'].lower():
+                continue
+            if CLOZEFIELD not in note or FURIGANAFIELD not in note or note[FURIGANAFIELD]:
+                continue
+            source = clozeText(note[CLOZEFIELD])
+            if source:
+                self.notes.append(note)
+                self.sources.append(source)
+
+    def run(self, progress=None, cancelled=None):
+        # Returns False if it was cancelled, the readings done so far are kept
+        service = mecabService()
+        for start in xrange(0, len(self.sources), BATCH_SIZE):
+            if cancelled and cancelled():
+                return False
+            self.readings.extend(service.readings(self.sources[start:start+BATCH_SIZE]))
+            if progress:
+                progress(len(self.readings))
         return True
+
+    def save(self):
+        # Writes the generated readings in one transaction and returns the number of notes changed
+        mw.checkpoint(_(u"Generate Furigana"))
+        for note, reading in zip(self.notes, self.readings):
+            note[FURIGANAFIELD] = reading
+            note.flush()
+        mw.col.save()
+        return len(self.readings)
         
 
 # Generate furigana for custom sentences
@@ -201,78 +270,12 @@ def onFocusLost(flag, note, fieldIdx):
 addHook("editFocusLost", onFocusLost)
 
 
-# Wrapper for mecab reading generator from Japanese Support plugin
+# Wrapper for the mecab reading generator from Japanese Support plugin, all of them share one MeCab process
 class ReadingGenerator():
     
     def __init__(self):
-        # The Japanese Support plugin reading module method patched by Pyry KONTIO 
-        def _reading(self, expr):
-        	self.ensureOpen()
-        	self.mecab.stdin.write(expr.replace(' ', '_BSP_').replace(u'\u00a0', '_NBSP_').encode("euc-jp", "ignore")+'\n')
-        	self.mecab.stdin.flush()
-        	expr = unicode(self.mecab.stdout.readline().rstrip('\r\n'), "euc-jp").replace('_NBSP_', u'\u00a0').replace('_BSP_', ' ')
-        	out = []
-        	inNode = False
-        	for node in re.split(ur"( [^ ]+?\[.*?\])", expr):
-        		if not inNode:
-        			out.append(node)
-        			inNode = True
-        			continue
-        		else:
-        			(kanji, reading) = re.match(ur" (.+?)\[(.*?)\]", node, flags=re.UNICODE).groups()
-        			inNode = False
-        		# hiragana, punctuation, not japanese, or lacking a reading
-        		if kanji == reading or not reading:
-        			out.append(kanji)
-        			continue
-        		# katakana
-        		if kanji == japanese.reading.kakasi.reading(reading):
-        			out.append(kanji)
-        			continue
-        		# convert to hiragana
-        		reading = japanese.reading.kakasi.reading(reading)
-        		# ended up the same
-        		if reading == kanji:
-        			out.append(kanji)
-        			continue
-        		# don't add readings of numbers
-        		if kanji in u"一二三四五六七八九十０１２３４５６７８９":
-        			out.append(kanji)
-        			continue
-        		# strip matching characters and beginning and end of reading and kanji
-        		# reading should always be at least as long as the kanji
-        		placeL = 0
-        		placeR = 0
-        		for i in range(1,len(kanji)):
-        			if kanji[-i] != reading[-i]:
-        				break
-        			placeR = i
-        		for i in range(0,len(kanji)-1):
-        			if kanji[i] != reading[i]:
-        				break
-        			placeL = i+1
-        		if placeL == 0:
-        			if placeR == 0:
-        				out.append(" %s[%s]" % (kanji, reading))
-        			else:
-        				out.append(" %s[%s]%s" % (
-        					kanji[:-placeR], reading[:-placeR], reading[-placeR:]))
-        		else:
-        			if placeR == 0:
-        				out.append("%s %s[%s]" % (
-        					reading[:placeL], kanji[placeL:], reading[placeL:]))
-        			else:
-        				out.append("%s %s[%s]%s" % (
-        					reading[:placeL], kanji[placeL:-placeR],
-        					reading[placeL:-placeR], reading[-placeR:]))
-        	fin = u""
-        	fin = ''.join(out)
-        	return fin
         try:
-            import japanese.reading
-            japanese.reading.mecabArgs = ['--node-format= %m[%f[7]]', '--eos-format=\n', '--unk-format=%m']
-            japanese.reading.MecabController.reading = _reading
-            self.mecab = japanese.reading.MecabController()
+            self.mecab = mecabService()
         except ImportError:
             self.mecab = None
             self.japaneseSupportExists()
@@ -288,13 +291,39 @@ class ReadingGenerator():
     def reading(self, expression):
         return self.mecab.reading(expression)        
 
+
+readingCache = None
+clozeCache = LRUCache(CLOZE_CACHE_SIZE)
+
+def readingStore():
+    # The reading cache, opened on first use
+    global readingCache
+    if readingCache is None:
+        readingCache = PersistentCache(READING_CACHE, READING_CACHE_SIZE, READING_CACHE_DISK_SIZE)
+    return readingCache
+
+def cachedReading(text):
+    # The reading of the text, generated by MeCab only when it is not cached yet
+    key = hashlib.sha1(text.encode('utf8')).hexdigest()
+    reading = readingStore().get(key)
+    if reading is None:
+        reading = ReadingGenerator().reading(text)
+        readingStore()[key] = reading
+    return reading
+
+
+def cacheReadings(texts):
+    # Generates the readings of the texts which are not cached yet in MeCab batches
+    missing = {}
+    for text in texts:
+        key = hashlib.sha1(text.encode('utf8')).hexdigest()
+        if readingStore().get(key) is None:
+            missing[key] = text
+    if missing:
+        readingStore().update(zip(missing.keys(), mecabService().readings(missing.values())))
+
         
 def highlightClozes(html, type, fields, model, data, col):
-    # Regular expression for finding the clozed expressions, i.e {{c1::example}}
-    cloze = r"\{\{c%s::(.*?)\}\}"
-    # Styles given word as cloze
-    style = "<span class=cloze>%s</span>"
-   
     # Checks if the model is correct
     if MODELNAME.lower() not in model['name'].lower():
         return html
@@ -304,40 +333,155 @@ def highlightClozes(html, type, fields, model, data, col):
     # Checks if the Furigana field is not empty. Cloze field is covered by Anki itself.
     if not fields[FURIGANAFIELD]:
         return u"The %s field is empty. Please edit this note and generate the reading." % FURIGANAFIELD
-               
-    # An implementation which allows user-editted readings    
-    if re.search(cloze % str(data[4]+1), fields[CLOZEFIELD]):
-        # Finds which cloze is being reviewed (cloze number data[4]+1) and returns the word with reading for it, if it exists
-        word = re.search(cloze % str(data[4]+1), ReadingGenerator().reading(fields[CLOZEFIELD])).group(1)
-                
-        results = []        
-        subgroups = []
-        furiganaBrackets = r"\[(.*?)\]"
-        
-        # Split the word into subgroups and strip the furigana from them
-        for split in word.split(" "):
-            if re.search(furiganaBrackets, split):
-                subgroups.append(re.sub(furiganaBrackets, "", split))    
-        
-        # Split the reading into columns
-        columns = fields[FURIGANAFIELD].split(" ")
-        if subgroups:
-            # For each column, check if it contains a subgroup. If it does, get the potentially user editted reading
-            # and update it in the word
-            for column in columns:
-                nofurigana = re.sub(furiganaBrackets, "", column)
-                match = re.search(furiganaBrackets, column)                
-                for subgroup in subgroups:
-                    if re.search(subgroup, nofurigana):                        
-                        results.append(re.sub(subgroup + furiganaBrackets, "%s[%s]" % (subgroup, match.group(1)), word))
-                        
-        # There was no furigana, use the word as it is
-        if not results:
-            results.append(word)
-        # Using furiganaToRuby find the word in card and substitute it for the version styled as cloze
-        for result in results:
-            html = re.sub(furiganaToRuby(result), style % furiganaToRuby(result), html)            
+
+    # The rubies only change with the fields, so they are looked for once per note and cloze
+    key = (data[1], data[4], hash(fields[CLOZEFIELD]), hash(fields[FURIGANAFIELD]))
+    rubies = clozeCache.get(key)
+    if rubies is None:
+        if PRERENDER:
+            rubies = storedRubies(col, data[1], fields[CLOZEFIELD], fields[FURIGANAFIELD], data[4]+1)
+        if rubies is None:
+            rubies = clozeRubies(fields[CLOZEFIELD], fields[FURIGANAFIELD], data[4]+1)
+        clozeCache[key] = rubies
+    # Find the word in card and substitute it for the version styled as cloze
+    for ruby in rubies:
+        html = html.replace(ruby, CLOZESTYLE % ruby)
     return html
-    
+
+
+def clozePattern(ordinal):
+    # Finds the clozed expressions with the ordinal, i.e {{c1::example}}
+    pattern = clozePatterns.get(ordinal)
+    if pattern is None:
+        pattern = clozePatterns[ordinal] = re.compile(r"\{\{c%d::(.*?)\}\}" % ordinal)
+    return pattern
+
+clozePatterns = {}
+
+
+def clozeRubies(cloze, furigana, ordinal):
+    # The rubies of the word under the cloze with the ordinal, as the Furigana field renders it.
+    # An implementation which allows user-editted readings
+    pattern = clozePattern(ordinal)
+    if not pattern.search(cloze):
+        return []
+    # Finds which cloze is being reviewed and returns the word with reading for it, if it exists
+    match = pattern.search(cachedReading(cloze))
+    if not match:
+        return []
+    word = match.group(1)
+
+    # Split the word into subgroups and strip the furigana from them
+    subgroups = [FURIGANABRACKETS.sub("", split) for split in word.split(" ") if FURIGANABRACKETS.search(split)]
+
+    # For each column of the reading which contains a subgroup, get the potentially user editted reading
+    # and update it in the word
+    results = []
+    if subgroups:
+        for column in furigana.split(" "):
+            match = FURIGANABRACKETS.search(column)
+            if not match:
+                continue
+            nofurigana = FURIGANABRACKETS.sub("", column)
+            for subgroup in subgroups:
+                if subgroup in nofurigana:
+                    results.append(replaceReading(word, subgroup, match.group(1)))
+
+    # There was no furigana, use the word as it is
+    if not results:
+        results.append(word)
+    return [furiganaToRuby(result) for result in results]
+
+
+def fieldsKey(cloze, furigana):
+    # Identifies the content the stored rubies were found for
+    return hashlib.sha1((cloze + u"\x1f" + furigana).encode('utf8')).hexdigest()
+
+
+def prerenderClozes(cloze, furigana):
+    # The rubies of every cloze of the note, by ordinal
+    ordinals = set(int(ordinal) for ordinal in CLOZEORDINALS.findall(cloze))
+    return {"key": fieldsKey(cloze, furigana),
+            "rubies": dict((str(ordinal), clozeRubies(cloze, furigana, ordinal)) for ordinal in ordinals)}
+
+
+def noteData(data):
+    # The note's data as a dictionary, None if something else keeps its own data there
+    if not data:
+        return {}
+    try:
+        data = json.loads(data)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def storeClozes(note):
+    # Saved along with the note by the editor
+    if not PRERENDER or not note[CLOZEFIELD] or not note[FURIGANAFIELD]:
+        return
+    data = noteData(note.data)
+    if data is not None:
+        data[DATAKEY] = prerenderClozes(note[CLOZEFIELD], note[FURIGANAFIELD])
+        note.data = json.dumps(data)
+
+
+def storedRubies(col, nid, cloze, furigana, ordinal):
+    # The stored rubies of the cloze, None if there are none for the current fields
+    data = noteData(col.db.scalar("select data from notes where id = ?", nid))
+    clozes = data.get(DATAKEY) if data else None
+    if not clozes or clozes.get("key") != fieldsKey(cloze, furigana):
+        return None
+    return clozes["rubies"].get(str(ordinal), [])
+
+
+def prerenderNotes():
+    # Stores the rubies of all Japanese Cloze notes; the readings are generated in MeCab batches.
+    # Only the local data column is written, so the notes are not marked as modified.
+    mids = [model['id'] for model in mw.col.models.all() if MODELNAME.lower() in model['name'].lower()]
+    notes = []
+    for mid in mids:
+        fieldMap = mw.col.models.fieldMap(mw.col.models.get(mid))
+        if CLOZEFIELD not in fieldMap or FURIGANAFIELD not in fieldMap:
+            continue
+        clozeOrd, furiganaOrd = fieldMap[CLOZEFIELD][0], fieldMap[FURIGANAFIELD][0]
+        for nid, flds, data in mw.col.db.execute("select id, flds, data from notes where mid = ?", mid):
+            fields = splitFields(flds)
+            if fields[clozeOrd] and fields[furiganaOrd] and noteData(data) is not None:
+                notes.append((nid, fields[clozeOrd], fields[furiganaOrd], data))
+
+    updates = []
+    mw.progress.start(max=len(notes), immediate=True, label=_(u"Storing the cloze highlighting..."))
+    try:
+        for start in xrange(0, len(notes), BATCH_SIZE):
+            batch = notes[start:start+BATCH_SIZE]
+            cacheReadings([cloze for nid, cloze, furigana, data in batch])
+            for nid, cloze, furigana, data in batch:
+                data = noteData(data)
+                data[DATAKEY] = prerenderClozes(cloze, furigana)
+                updates.append((json.dumps(data), nid))
+            mw.progress.update(value=len(updates))
+    finally:
+        mw.progress.finish()
+    mw.col.db.executemany("update notes set data = ? where id = ?", updates)
+    mw.col.save()
+    return len(updates)
+
+
+def replaceReading(word, subgroup, reading):
+    # Sets the reading of every subgroup[...] in the word
+    out = []
+    position = 0
+    while True:
+        start = word.find(subgroup + "[", position)
+        end = word.find("]", start + len(subgroup) + 1) if start >= 0 else -1
+        if end < 0:
+            out.append(word[position:])
+            return "".join(out)
+        out.append(word[position:start])
+        out.append("%s[%s]" % (subgroup, reading))
+        position = end + 1
+
+
 # Calls highlightClozes when card is being rendered
 addHook("mungeQA", highlightClozes)
\ No newline at end of file
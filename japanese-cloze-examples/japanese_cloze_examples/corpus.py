@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+#
+# Description: Gives a list of example sentences from Tanaka Corpus for the searched expression
+# and generates a cloze card for the chosen sentence, complete with furigana. Generates furigana for custom sentences as well.
+# This addon is based on Guillaume VIRY's example sentences plugin for Anki and some code from Pyry KONTIO's Cloze Furigana Tools.
+# Version 1.0, released 2014-07-20
+#
+# Author: Radek SPRTA
+# Email: radek.sprta@gmail.com
+# License: GNU AGPL
+
+import os
+import mmap
+import struct
+import hashlib
+from array import array
+
+from index import corpusStamp, corpusHash
+
+
+# Size, mtime and MD5 of the corpus the offset table was built from, as in the header of the index
+OFFSETS_HEADER = struct.Struct("<Qd16s")
+
+
+def readOffsets(path, offsetsPath):
+    # Returns the offset table of the corpus, or None if it is missing, truncated
+    # or was built from another corpus
+    try:
+        f = open(offsetsPath, 'rb')
+    except IOError:
+        return None
+    try:
+        header = f.read(OFFSETS_HEADER.size)
+        if len(header) < OFFSETS_HEADER.size:
+            return None
+        size, mtime, digest = OFFSETS_HEADER.unpack(header)
+        offsets = array('I')
+        offsets.fromfile(f, (os.fstat(f.fileno()).st_size - OFFSETS_HEADER.size) // offsets.itemsize)
+    finally:
+        f.close()
+    stamp = corpusStamp(path)
+    # A table cut short ends before the end of the corpus
+    if not offsets or offsets[0] != 0 or offsets[-1] != stamp[0]:
+        return None
+    # A touched but unchanged corpus keeps its offsets, remember the new stamp so it is not hashed again
+    if stamp != (size, mtime):
+        if digest != corpusHash(path):
+            return None
+        try:
+            f = open(offsetsPath, 'r+b')
+            f.write(OFFSETS_HEADER.pack(stamp[0], stamp[1], digest))
+            f.close()
+        except IOError:
+            pass
+    return offsets
+
+
+# Read-only view of a UTF-8 corpus file. Only the byte offsets of the lines are kept in memory,
+# the file itself is memory-mapped and a line is decoded when it is asked for.
+class Corpus():
+
+    def __init__(self, path, offsetsPath):
+        self.path = path
+        self.offsetsPath = offsetsPath
+        self.offsets = array('I')
+
+        # Open the offset table if it is up to date with the corpus, build it otherwise
+        offsets = readOffsets(path, offsetsPath)
+        if offsets is not None:
+            self.offsets = offsets
+        else:
+            self.buildOffsets()
+            self.saveOffsets()
+        self.map()
+
+    def map(self):
+        # mmap refuses empty files, fall back to an empty string
+        f = open(self.path, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ""
+        finally:
+            f.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = ""
+
+    def buildOffsets(self):
+        # The table holds the start of every line followed by the end of the file
+        offsets = array('I', [0])
+        position = 0
+        md5 = hashlib.md5()
+        f = open(self.path, 'rb')
+        stamp = corpusStamp(self.path)
+        for line in f:
+            position += len(line)
+            offsets.append(position)
+            md5.update(line)
+        f.close()
+        self.offsets = offsets
+        self.stamp = stamp
+        self.digest = md5.digest()
+
+    def saveOffsets(self):
+        f = open(self.offsetsPath, 'wb')
+        f.write(OFFSETS_HEADER.pack(self.stamp[0], self.stamp[1], self.digest))
+        self.offsets.tofile(f)
+        f.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        # Returns the i-th line including its line break, as readlines() did
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("corpus line out of range")
+        return self.data[self.offsets[i]:self.offsets[i+1]].decode('utf8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
@@ -32,9 +32,9 @@ class Ui_selectDialog(object):
         self.verticalLayout.setSpacing(3)
         self.verticalLayout.setMargin(12)
         self.verticalLayout.setObjectName(_fromUtf8("verticalLayout"))
-        self.listWidget = QtGui.QListWidget(sentenceDialog)
-        self.listWidget.setObjectName(_fromUtf8("listWidget"))
-        self.verticalLayout.addWidget(self.listWidget)
+        self.listView = QtGui.QListView(sentenceDialog)
+        self.listView.setObjectName(_fromUtf8("listView"))
+        self.verticalLayout.addWidget(self.listView)
         self.buttonBox = QtGui.QDialogButtonBox(sentenceDialog)
         self.buttonBox.setOrientation(QtCore.Qt.Horizontal)
         self.buttonBox.setStandardButtons(QtGui.QDialogButtonBox.Cancel|QtGui.QDialogButtonBox.Ok)
@@ -48,7 +48,4 @@ class Ui_selectDialog(object):
 
     def retranslateUi(self, SentenceDialog):
         SentenceDialog.setWindowTitle(_translate("sentenceDialog", "Choose an example sentence", None))
-        __sortingEnabled = self.listWidget.isSortingEnabled()
-        self.listWidget.setSortingEnabled(False)
-        self.listWidget.setSortingEnabled(__sortingEnabled)
 
@@ -0,0 +1,475 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+#
+# Description: Gives a list of example sentences from Tanaka Corpus for the searched expression
+# and generates a cloze card for the chosen sentence, complete with furigana. Generates furigana for custom sentences as well.
+# This addon is based on Guillaume VIRY's example sentences plugin for Anki and some code from Pyry KONTIO's Cloze Furigana Tools.
+# Version 1.0, released 2014-07-20
+#
+# Author: Radek SPRTA
+# Email: radek.sprta@gmail.com
+# License: GNU AGPL
+
+import os
+import sys
+import mmap
+import struct
+import heapq
+import hashlib
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+from operator import itemgetter, add
+
+
+# Bump the version whenever the layout of the index file changes
+MAGIC = "JCEI"
+VERSION = 5
+# Flags of the index file
+SPANS = 1
+# magic, version, flags, corpus size, corpus mtime, corpus md5, number of terms,
+# start of the postings, start of the posting offsets, start of the terms, length of the terms,
+# start of the suffixes, number of suffixes, start of the sentence scores, number of sentence scores,
+# start of the ranked postings
+HEADER = struct.Struct("<4sIIQd16sIQQQQQQQQQ")
+# Term number and character offset of an entry in the suffix table
+SUFFIX = struct.Struct("<II")
+# Length of the UTF-8 term, number of postings and number of span values of a record in a run file
+RUN_RECORD = struct.Struct("<HII")
+# Number of sentences whose postings are kept in memory while building
+RUN_SIZE = 20000
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+def corpusStamp(path):
+    # Cheap identity of the corpus file, checked before falling back to the content hash
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+
+def corpusHash(path):
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    for chunk in iter(lambda: f.read(1 << 20), ""):
+        md5.update(chunk)
+    f.close()
+    return md5.digest()
+
+
+def toDisk(arr):
+    # The index is always stored little-endian
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+
+def fromDisk(typecode, data):
+    arr = array(typecode)
+    arr.fromstring(data)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+# Writes the word index of a corpus. The layout is
+#   header | postings | posting offsets | sorted terms | sorted suffixes | sentence scores | ranked postings
+# so the postings can be streamed out before the term table is known.
+# The postings of every term are followed by a byte per posting telling if the word is conjugated
+# in that sentence and, with spans, by the (start, end) character span of the highlighted word.
+# The suffix table lists every proper suffix of every term in sorted order, for substring search.
+# The sentence scores rank the examples, they are indexed by line number. The ranked postings
+# list, for every term, the positions of its postings from the best scored example to the worst.
+class IndexWriter():
+
+    def __init__(self, path, corpusPath, spans=False):
+        self.path = path
+        self.tmpPath = path + ".tmp"
+        self.corpusPath = corpusPath
+        self.flags = SPANS if spans else 0
+        self.terms = []
+        self.postingOffsets = array('I', [0])
+        self.count = 0
+        self.lastTerm = None
+        self.f = open(self.tmpPath, 'wb')
+        self.f.write("\0" * HEADER.size)
+
+    def add(self, term, postings, forms=None, spans=None):
+        # Terms must come in sorted order, postings in ascending order
+        assert self.lastTerm is None or term > self.lastTerm
+        self.lastTerm = term
+        if not isinstance(postings, array):
+            postings = array('I', postings)
+        if forms is None:
+            forms = array('B', [0]) * len(postings)
+        assert len(forms) == len(postings)
+        self.f.write(toDisk(postings))
+        self.f.write(toDisk(forms))
+        if self.flags & SPANS:
+            assert len(spans) == 2 * len(postings)
+            self.f.write(toDisk(spans))
+        self.count += len(postings)
+        self.terms.append(term)
+        self.postingOffsets.append(self.count)
+
+    def documentFrequencies(self):
+        # Number of sentences each of the terms added so far appears in
+        offsets = self.postingOffsets
+        return dict((term, offsets[i+1] - offsets[i]) for i, term in enumerate(self.terms))
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmpPath)
+
+    def close(self, scores=None, formScores=(0.0, 0.0)):
+        # scores is called with the document frequencies and returns the sentence scores,
+        # formScores are added to them for a word in dictionary form and conjugated when ranking
+        postingsStart = HEADER.size
+        offsetsStart = self.f.tell()
+        self.f.write(toDisk(self.postingOffsets))
+        termsStart = self.f.tell()
+        terms = u"\n".join(self.terms).encode('utf8')
+        self.f.write(terms)
+        suffixesStart = self.f.tell()
+        suffixes = sorted((term[k:], t, k) for t, term in enumerate(self.terms) for k in xrange(1, len(term)))
+        for suffix, t, k in suffixes:
+            self.f.write(SUFFIX.pack(t, k))
+        scoresStart = self.f.tell()
+        sentenceScores = scores(self.documentFrequencies()) if scores else array('f')
+        self.f.write(toDisk(sentenceScores))
+        rankedStart = self.f.tell()
+        if sentenceScores:
+            self.writeRanked(sentenceScores, formScores)
+
+        size, mtime = corpusStamp(self.corpusPath)
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, self.flags, size, mtime, corpusHash(self.corpusPath),
+                                 len(self.terms), postingsStart, offsetsStart, termsStart, len(terms),
+                                 suffixesStart, len(suffixes), scoresStart, len(sentenceScores), rankedStart))
+        self.f.close()
+
+    def writeRanked(self, sentenceScores, formScores):
+        # Reads the postings back term by term; ties keep the corpus order so the ranking is stable
+        self.f.flush()
+        entrySize = 9 if self.flags & SPANS else 5
+        f = open(self.tmpPath, 'rb')
+        try:
+            for i in xrange(len(self.terms)):
+                count = self.postingOffsets[i+1] - self.postingOffsets[i]
+                f.seek(HEADER.size + self.postingOffsets[i] * entrySize)
+                postings = fromDisk('I', f.read(count * 4))
+                forms = fromDisk('B', f.read(count))
+                termScores = map(add, map(sentenceScores.__getitem__, postings), map(formScores.__getitem__, forms))
+                ranked = sorted(xrange(count), key=termScores.__getitem__, reverse=True)
+                self.f.write(toDisk(array('I', ranked)))
+        finally:
+            f.close()
+
+    def commit(self):
+        # Replace the old index; Windows does not allow renaming over an existing file
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.tmpPath, self.path)
+
+
+def writeIndex(path, corpusPath, dictionary):
+    # Writes an index from a word -> line numbers dictionary
+    writer = IndexWriter(path, corpusPath)
+    try:
+        for term in sorted(dictionary):
+            writer.add(term, dictionary[term])
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    writer.commit()
+
+
+def buildIndex(path, corpusPath, sentences, spans=False, scores=None, formScores=(0.0, 0.0)):
+    # Builds the index from (line number, words) pairs coming in ascending line order.
+    # words maps each word to (conjugated,), or to (conjugated, start, end) of its highlight with spans.
+    # Postings are collected for RUN_SIZE sentences at a time and spilled into sorted run files,
+    # which are merged into the index at the end, so memory use does not grow with the corpus.
+    # Returns the writer, whose commit() puts the new index in place.
+    writer = IndexWriter(path, corpusPath, spans)
+    runs = []
+    try:
+        run = {}
+        for n, (line, words) in enumerate(sentences, 1):
+            for word, entry in words.iteritems():
+                postings = run.get(word)
+                if postings is None:
+                    postings = run[word] = (array('I'), array('B'), array('H'))
+                postings[0].append(line)
+                postings[1].append(entry[0])
+                if spans:
+                    postings[2].extend(entry[1:])
+            if not n % RUN_SIZE:
+                runs.append(writeRun(run, "%s.run%d" % (path, len(runs))))
+                run = {}
+        if runs:
+            if run:
+                runs.append(writeRun(run, "%s.run%d" % (path, len(runs))))
+            merged = mergeRuns(runs)
+        else:
+            merged = ((term,) + run[term] for term in sorted(run))
+        for term, postings, forms, termSpans in merged:
+            writer.add(term, postings, forms, termSpans)
+        writer.close(scores, formScores)
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        for run in runs:
+            os.remove(run)
+    return writer
+
+
+def writeRun(run, path):
+    f = open(path, 'wb')
+    for term in sorted(run):
+        encoded = term.encode('utf8')
+        postings, forms, spans = run[term]
+        f.write(RUN_RECORD.pack(len(encoded), len(postings), len(spans)))
+        f.write(encoded)
+        f.write(toDisk(postings))
+        f.write(toDisk(forms))
+        f.write(toDisk(spans))
+    f.close()
+    return path
+
+
+def readRun(path, order):
+    # Yields (term, order, postings, forms, spans) so that runs merge by term and then by corpus position
+    f = open(path, 'rb')
+    try:
+        while True:
+            record = f.read(RUN_RECORD.size)
+            if not record:
+                break
+            length, count, spanCount = RUN_RECORD.unpack(record)
+            term = f.read(length).decode('utf8')
+            yield (term, order, fromDisk('I', f.read(count * 4)), fromDisk('B', f.read(count)),
+                   fromDisk('H', f.read(spanCount * 2)))
+    finally:
+        f.close()
+
+
+def mergeRuns(runs):
+    # Runs cover consecutive parts of the corpus, so joining them in order keeps the postings sorted
+    records = heapq.merge(*[readRun(run, order) for order, run in enumerate(runs)])
+    for term, group in groupby(records, itemgetter(0)):
+        postings = array('I')
+        forms = array('B')
+        spans = array('H')
+        for record in group:
+            postings.extend(record[2])
+            forms.extend(record[3])
+            spans.extend(record[4])
+        yield term, postings, forms, spans
+
+
+def gallop(postings, value, lo):
+    # Position of the first posting not less than value, probing from lo in growing steps
+    step = 1
+    hi = lo
+    while hi < len(postings) and postings[hi] < value:
+        lo = hi + 1
+        hi = lo + step
+        step *= 2
+    return bisect_left(postings, value, lo, min(hi, len(postings)))
+
+
+def intersect(shorter, longer):
+    # Postings in both sorted lists; gallops through the longer one, so a rare word
+    # intersected with a very common one costs little more than the rare word's postings
+    result = []
+    j = 0
+    for value in shorter:
+        j = gallop(longer, value, j)
+        if j == len(longer):
+            break
+        if longer[j] == value:
+            result.append(value)
+    return result
+
+
+def difference(postings, excluded):
+    # Postings which are not among the sorted excluded ones
+    result = []
+    j = 0
+    for value in postings:
+        j = gallop(excluded, value, j)
+        if j == len(excluded) or excluded[j] != value:
+            result.append(value)
+    return result
+
+
+def union(postingLists):
+    if len(postingLists) == 1:
+        return list(postingLists[0])
+    return sorted(set().union(*postingLists))
+
+
+def contains(postings, value):
+    # Position of the value in the sorted postings, or -1
+    i = bisect_left(postings, value)
+    if i < len(postings) and postings[i] == value:
+        return i
+    return -1
+
+
+# Read-only word index backed by a memory-mapped file. Behaves like the dictionary
+# of word -> line numbers it replaces, but a posting list is decoded only when asked for.
+class Index():
+
+    def __init__(self, path, corpusPath):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            # An empty file cannot be mapped, e.g. after a crash while it was written
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise IndexFormatError("index file is truncated")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            self.load(corpusPath)
+        except Exception:
+            self.close()
+            raise
+
+    def load(self, corpusPath):
+        if len(self.data) < HEADER.size:
+            raise IndexFormatError("index file is truncated")
+        (magic, version, self.flags, size, mtime, digest, termCount, self.postingsStart, offsetsStart,
+         termsStart, termsLength, self.suffixesStart, self.suffixCount,
+         self.scoresStart, self.scoreCount, self.rankedStart) = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise IndexFormatError("index file has an unknown format")
+        # A touched but unchanged corpus keeps its index, remember the new stamp so it is not hashed again
+        stamp = corpusStamp(corpusPath)
+        if stamp != (size, mtime):
+            if digest != corpusHash(corpusPath):
+                raise IndexFormatError("index file is out of date")
+            self.updateStamp(stamp)
+
+        self.postingOffsets = fromDisk('I', self.data[offsetsStart:termsStart])
+        terms = self.data[termsStart:termsStart+termsLength].decode('utf8')
+        self.terms = terms.split(u"\n") if terms else []
+        if len(self.terms) != termCount or len(self.postingOffsets) != termCount + 1:
+            raise IndexFormatError("index file is corrupted")
+        self.hasSpans = bool(self.flags & SPANS)
+        self.hasScores = self.scoreCount > 0
+        self.scores = None
+        # Bytes taken by each posting, including its form and span
+        self.entrySize = 9 if self.hasSpans else 5
+
+    def updateStamp(self, stamp):
+        header = list(HEADER.unpack_from(self.data))
+        header[3:5] = stamp
+        try:
+            f = open(self.path, 'r+b')
+            f.write(HEADER.pack(*header))
+            f.close()
+        except IOError:
+            pass
+
+    def close(self):
+        self.data.close()
+
+    def find(self, term):
+        # Position of the term in the sorted term table, or -1
+        i = bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return -1
+
+    def prefixed(self, prefix, limit):
+        # Up to limit terms starting with the prefix, in sorted order
+        terms = []
+        i = bisect_left(self.terms, prefix)
+        while i < len(self.terms) and len(terms) < limit and self.terms[i].startswith(prefix):
+            terms.append(self.terms[i])
+            i += 1
+        return terms
+
+    def suffix(self, i):
+        # Term number and text of the i-th entry of the suffix table
+        t, k = SUFFIX.unpack_from(self.data, self.suffixesStart + i * SUFFIX.size)
+        return t, self.terms[t][k:]
+
+    def containing(self, text, limit):
+        # Up to limit terms which contain the text anywhere but at their start
+        lo, hi = 0, self.suffixCount
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.suffix(mid)[1] < text:
+                lo = mid + 1
+            else:
+                hi = mid
+        terms = []
+        seen = set()
+        while lo < self.suffixCount and len(terms) < limit:
+            t, suffix = self.suffix(lo)
+            if not suffix.startswith(text):
+                break
+            if t not in seen:
+                seen.add(t)
+                terms.append(self.terms[t])
+            lo += 1
+        return terms
+
+    def postingSlice(self, i):
+        # Raw postings of the i-th term, straight from the mapped file
+        start = self.postingsStart + self.postingOffsets[i] * self.entrySize
+        return buffer(self.data, start, (self.postingOffsets[i+1] - self.postingOffsets[i]) * 4)
+
+    def postings(self, i):
+        return fromDisk('I', self.postingSlice(i))
+
+    def forms(self, i):
+        # For each posting of the i-th term, 1 if the word is conjugated in the sentence
+        count = self.postingOffsets[i+1] - self.postingOffsets[i]
+        start = self.postingsStart + self.postingOffsets[i] * self.entrySize + count * 4
+        return fromDisk('B', buffer(self.data, start, count))
+
+    def spans(self, i):
+        # Highlight spans of the i-th term, start and end for each posting
+        count = self.postingOffsets[i+1] - self.postingOffsets[i]
+        start = self.postingsStart + self.postingOffsets[i] * self.entrySize + count * 5
+        return fromDisk('H', buffer(self.data, start, count * 4))
+
+    def sentenceScores(self):
+        # Scores of the examples by line number, read when they are first needed
+        if self.scores is None:
+            self.scores = fromDisk('f', buffer(self.data, self.scoresStart, self.scoreCount * 4))
+        return self.scores
+
+    def ranked(self, i, start, stop):
+        # Positions of the start-th to stop-th best scored postings of the i-th term
+        count = self.postingOffsets[i+1] - self.postingOffsets[i]
+        start, stop = min(start, count), min(stop, count)
+        offset = self.rankedStart + (self.postingOffsets[i] + start) * 4
+        return fromDisk('I', buffer(self.data, offset, (stop - start) * 4))
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __getitem__(self, term):
+        i = self.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.postings(i)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def keys(self):
+        return list(self.terms)
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+#
+# Description: Gives a list of example sentences from Tanaka Corpus for the searched expression 
+# and generates a cloze card for the chosen sentence, complete with furigana. Generates furigana for custom sentences as well.
+# This addon is based on Guillaume VIRY's example sentences plugin for Anki and some code from Pyry KONTIO's Cloze Furigana Tools.
+# Version 1.0, released 2014-07-20
+#
+# Author: Radek SPRTA
+# Email: radek.sprta@gmail.com
+# License: GNU AGPL
+
+import re
+import threading
+from os.path import commonprefix
+
+
+MECAB_ARGS = ['--node-format= %m[%f[7]]', '--eos-format=\n', '--unk-format=%m']
+# Number of lines written to MeCab before its answers are read in a batch
+BATCH_SIZE = 500
+# MeCab answers every line with a line, so spaces and line breaks are sent as placeholders
+ESCAPES = [(u' ', u'_BSP_'), (u'\u00a0', u'_NBSP_'), (u'\r', u'_CR_'), (u'\n', u'_LF_')]
+# A word and its reading in the MeCab output
+NODE = re.compile(ur" ([^ ]+?)\[(.*?)\]")
+# Readings made only of these are converted to hiragana without kakasi
+KANA = re.compile(u"[\u3041-\u3093\u30a1-\u30f3\u30fc]*$")
+KATAKANA_TO_HIRAGANA = dict((code, code - 0x60) for code in xrange(0x30a1, 0x30f4))
+NUMBERS = u"一二三四五六七八九十０１２３４５６７８９"
+
+
+def escape(expr):
+    for char, placeholder in ESCAPES:
+        expr = expr.replace(char, placeholder)
+    return expr
+
+
+def unescape(expr):
+    for char, placeholder in reversed(ESCAPES):
+        expr = expr.replace(placeholder, char)
+    return expr
+
+
+def _setup(self):
+    # Builds the MeCab command with MECAB_ARGS. Japanese Support reads its mecabArgs global here,
+    # which is given back right after so that its own controller keeps its output format.
+    import japanese.reading
+    mecabArgs = japanese.reading.mecabArgs
+    japanese.reading.mecabArgs = MECAB_ARGS
+    try:
+        japanese.reading.MecabController.setup(self)
+    finally:
+        japanese.reading.mecabArgs = mecabArgs
+
+
+# The Japanese Support plugin reading module method patched by Pyry KONTIO
+def _reading(self, expr):
+    self.ensureOpen()
+    self.mecab.stdin.write(escape(expr).encode("euc-jp", "ignore")+'\n')
+    self.mecab.stdin.flush()
+    return formatReading(readLine(self.mecab))
+
+
+def _readings(self, exprs):
+    # Pipelined version of _reading: all the lines are written, by another thread so that neither
+    # pipe can fill up and block MeCab, while the answers are read
+    self.ensureOpen()
+    process = self.mecab
+    data = "".join(escape(expr).encode("euc-jp", "ignore")+'\n' for expr in exprs)
+    def feed():
+        try:
+            process.stdin.write(data)
+            process.stdin.flush()
+        except (IOError, ValueError):
+            # MeCab died, reading its answers fails as well
+            pass
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        return [formatReading(readLine(process)) for expr in exprs]
+    except Exception:
+        # Nobody reads the answers any more, MeCab and the feeder would block on the full pipes
+        try:
+            process.kill()
+        except OSError:
+            pass
+        raise
+    finally:
+        feeder.join()
+
+
+def readLine(process):
+    line = process.stdout.readline()
+    if not line.endswith('\n'):
+        raise IOError("MeCab exited")
+    return unescape(unicode(line.rstrip('\r\n'), "euc-jp"))
+
+
+def formatReading(expr):
+    # Turns the " kanji[reading]" nodes of the MeCab output into furigana, in one pass over the line
+    out = []
+    position = 0
+    for node in NODE.finditer(expr):
+        out.append(expr[position:node.start()])
+        out.append(furigana(*node.groups()))
+        position = node.end()
+    out.append(expr[position:])
+    return u"".join(out)
+
+
+def furigana(kanji, reading):
+    # hiragana, punctuation, not japanese, or lacking a reading
+    if kanji == reading or not reading:
+        return kanji
+    # katakana, or the same once converted to hiragana
+    reading = hiragana(reading)
+    if kanji == reading:
+        return kanji
+    # don't add readings of numbers
+    if kanji in NUMBERS:
+        return kanji
+    # strip matching characters at the beginning and end of reading and kanji, keeping at least one kanji
+    placeL = len(commonprefix([kanji[:-1], reading]))
+    placeR = len(commonprefix([kanji[:0:-1], reading[::-1]]))
+    return u"%s %s[%s]%s" % (reading[:placeL], kanji[placeL:len(kanji)-placeR],
+                             reading[placeL:len(reading)-placeR], reading[len(reading)-placeR:])
+
+
+def hiragana(reading):
+    # Kana are converted by the table, anything else is left to kakasi
+    if KANA.match(reading):
+        return reading.translate(KATAKANA_TO_HIRAGANA)
+    import japanese.reading
+    return japanese.reading.kakasi.reading(reading)
+
+
+# One MeCab process shared by the whole add-on. It is started on the first request and restarted
+# when it died or its pipe broke. Requests may come from any thread, they are answered one at a time.
+class MecabService():
+
+    def __init__(self):
+        # Raises ImportError without the Japanese Support plugin
+        import japanese.reading
+        self.controller = japanese.reading.MecabController()
+        self.controller.setup = _setup.__get__(self.controller)
+        self.controller.reading = _reading.__get__(self.controller)
+        self.controller.readings = _readings.__get__(self.controller)
+        self.lock = threading.RLock()
+
+    def isAlive(self):
+        process = self.controller.mecab
+        return process is not None and process.poll() is None
+
+    def stop(self):
+        process = self.controller.mecab
+        self.controller.mecab = None
+        if process is not None and process.poll() is None:
+            try:
+                process.kill()
+                process.wait()
+            except OSError:
+                pass
+
+    def reading(self, expression):
+        with self.lock:
+            # A process which exited is replaced before the request is sent
+            if self.controller.mecab is not None and not self.isAlive():
+                self.stop()
+            try:
+                return self.controller.reading(expression)
+            except (IOError, OSError, ValueError):
+                # Broken pipe; the answer of a half-done request must not be read by the next one
+                self.stop()
+                return self.controller.reading(expression)
+
+    def readings(self, expressions):
+        # Readings of many expressions, sent to MeCab BATCH_SIZE at a time
+        readings = []
+        for start in xrange(0, len(expressions), BATCH_SIZE):
+            batch = expressions[start:start+BATCH_SIZE]
+            with self.lock:
+                if self.controller.mecab is not None and not self.isAlive():
+                    self.stop()
+                try:
+                    readings.extend(self.controller.readings(batch))
+                except (IOError, OSError, ValueError):
+                    self.stop()
+                    readings.extend(self.controller.readings(batch))
+                except Exception:
+                    # The process was killed with the rest of the batch's answers unread
+                    self.stop()
+                    raise
+        return readings
+
+
+service = None
+serviceLock = threading.Lock()
+
+def mecabService():
+    # The shared MecabService, raises ImportError without the Japanese Support plugin
+    global service
+    with serviceLock:
+        if service is None:
+            service = MecabService()
+    return service
@@ -14,55 +14,280 @@
 
 import os
 import re
+import struct
 import cPickle
-import codecs
+import math
+import heapq
 import random
+import threading
+from array import array
+from itertools import islice
 
 from aqt import mw
+from anki.lang import _
+
+from cache import LRUCache
+from corpus import Corpus, readOffsets
+from index import Index, IndexFormatError, buildIndex, intersect, difference, union, contains
 
 
 MAX = 25
+# Maximum number of dictionary keys suggested for a partial expression
+MAX_KEYS = 20
+# The Tanaka corpus. Its pickle, offsets and index files are kept next to it under the same name.
 FILE = os.path.join(mw.pm.addonFolder(), "japanese_cloze_examples.utf")
-FILE_PICKLE = os.path.join(mw.pm.addonFolder(), "japanese_cloze_examples.pickle")
+# Further corpora in the same format, every .utf file in the folder is searched as well
+CORPORA = os.path.join(mw.pm.addonFolder(), "japanese_cloze_examples_corpora")
+# Number of examples reserved for a corpus, by file name. Corpora without a quota share the rest
+# of MAX equally, and what a corpus cannot fill is given to the others.
+QUOTAS = {}
+# Report the build progress every PROGRESS_STEP lines
+PROGRESS_STEP = 2000
+SPLITTER = re.compile('\s|\[|\]|\(|\{|\)|\}')
+# Fallbacks for expressions which are not in the dictionary
+SLASH = re.compile(u"(.*?)[／/]")
+BRACKETS = re.compile(u"(.*?)[(（](.+?)[)）]")
+# Terms of a query are separated by spaces, including the Japanese full-width one
+QUERY_SEPARATOR = re.compile(u"[ \u3000]+")
+# Finds the conjugated form and the reading of an escaped expression in a colour line
+CONJUGATED = ur"(?:\(*%s\)*)(?:\([^\s]+?\))*(?:\[\d+\])*(?:\{(.+?)\})"
+READING = ur"(?:\s([^\s]*?))(?:\(%s\))"
+HIGHLIGHT = u'<FONT COLOR="#0000ff">%s</FONT>'
+# Number of expressions whose compiled patterns are kept
+PATTERN_CACHE_SIZE = 256
+# Number of searches whose results are kept
+RESULT_CACHE_SIZE = 64
+# Store where the word is highlighted in each example in the index. Searches then need
+# no regular expressions, but building the index takes longer.
+SPANS = False
+# Span of a word which could not be located in the Japanese sentence
+NOSPAN = 0xFFFF
+# Show the best examples instead of a random sample. The examples are ranked when the index is built,
+# so changing the weights below needs the index to be rebuilt.
+RANKED = True
+IDEAL_LENGTH = 15
+LENGTH_WEIGHT = 0.1
+COMMON_WEIGHT = 1.0
+# Added to the score of an example with the word in dictionary form [0] and conjugated [1]
+FORM_SCORES = (0.5, 0.0)
 
 
 # Modified from Guillaume VIRY's example sentences plugin
 class Dictionary():  
  
-    def __init__(self):
+    def __init__(self, path=FILE):
+        self.path = path
+        self.name = os.path.basename(path)
+        base = os.path.splitext(path)[0]
+        self.picklePath = base + ".pickle"
+        self.offsetsPath = base + ".offsets"
+        self.indexPath = base + ".index"
         self.dictionary = {}         
-        
-        f = codecs.open(FILE, 'r', 'utf8')
-        self.content = f.readlines()
-        f.close() 
-        
+        self.patternCache = LRUCache(PATTERN_CACHE_SIZE)
+        self.resultCache = LRUCache(RESULT_CACHE_SIZE)
+        # Searches may run in another thread, they must not see the index being swapped
+        # or another search changing the caches
+        self.lock = threading.RLock()
+        # Counts the index swaps, so that a cursor over the previous index knows to stop
+        self.generation = 0
+        # A background rebuild is running, it would share its temporary files with another one
+        self.rebuilding = False
+        self.open()
+
+    def open(self):
+        self.resultCache.clear()
+        self.generation += 1
+        # The corpus stays on disk, lines are decoded only when an example is returned
+        self.content = Corpus(self.path, self.offsetsPath)
+        try:
+            self.openIndex()
+        except (IOError, OSError, IndexFormatError, struct.error):
+            # The index could not be read or written, use the pickled dictionary instead
+            self.openPickle()
+
+    def openIndex(self):
+        # Open index file if it is up to date with the corpus, build it otherwise
+        if os.path.exists(self.indexPath):
+            try:
+                index = Index(self.indexPath, self.path)
+                if index.hasSpans == SPANS:
+                    self.dictionary = index
+                    return
+                index.close()
+            except IndexFormatError:
+                pass
+        mw.progress.start(max=os.stat(self.path).st_size // 1024, immediate=True,
+                          label=_(u"Building the example sentence index..."))
+        try:
+            self.buildIndex(self.updateProgress).commit()
+        finally:
+            mw.progress.finish()
+        self.dictionary = Index(self.indexPath, self.path)
+
+    def updateProgress(self, position):
+        mw.progress.update(value=position // 1024)
+
+    def buildIndex(self, progress=None):
+        # Streams the corpus into a new index file, which is put in place by commit() of the returned writer
+        return buildIndex(self.indexPath, self.path, self.sentenceWords(progress, SPANS), SPANS, self.sentenceScores, FORM_SCORES)
+
+    def openPickle(self):
         # Open dictionary file if it exists, build it otherwise
-        if (os.path.exists(FILE_PICKLE) and
-            os.stat(FILE_PICKLE).st_mtime > os.stat(FILE).st_mtime):
-            f = open(FILE_PICKLE, 'rb')
+        if (os.path.exists(self.picklePath) and
+            os.stat(self.picklePath).st_mtime > os.stat(self.path).st_mtime):
+            f = open(self.picklePath, 'rb')
             self.dictionary = cPickle.load(f)
             f.close()
         else:
+            self.dictionary = {}
             self.buildDictionary()
-            f = open(FILE_PICKLE, 'wb')
+            f = open(self.picklePath, 'wb')
             cPickle.dump(self.dictionary, f, cPickle.HIGHEST_PROTOCOL)
             f.close()
+
+    def rebuild(self, background=False, onDone=None):
+        # Rebuilds the corpus offsets and the index, e.g. after the corpus file was replaced.
+        # In the background the current index keeps serving lookups until the new one is ready.
+        # Returns False if a rebuild is running already, the request is then ignored.
+        if self.rebuilding:
+            return False
+        if not background:
+            with self.lock:
+                self.close()
+                for path in (self.offsetsPath, self.indexPath):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.open()
+            return True
+
+        self.rebuilding = True
+        result = []
+        def build():
+            try:
+                result.append(self.buildIndex())
+            except Exception, e:
+                result.append(e)
+        thread = threading.Thread(target=build)
+        thread.daemon = True
+        thread.start()
+
+        # The index is swapped on the main thread, nothing else may touch it there
+        def swap():
+            if thread.is_alive():
+                return
+            timer.stop()
+            if isinstance(result[0], Exception):
+                self.rebuilding = False
+                if onDone:
+                    onDone(False)
+                return
+            with self.lock:
+                self.close()
+                try:
+                    result[0].commit()
+                    if os.path.exists(self.offsetsPath):
+                        os.remove(self.offsetsPath)
+                finally:
+                    self.rebuilding = False
+                    self.open()
+            if onDone:
+                onDone(True)
+        timer = mw.progress.timer(100, swap, True)
+        return True
+
+    def close(self):
+        self.content.close()
+        if isinstance(self.dictionary, Index):
+            self.dictionary.close()
+        self.dictionary = {}
     
+    def sentenceWords(self, progress=None, spans=False):
+        # Streams (line number, words) of every example straight from the corpus file.
+        # words maps each word to (conjugated,), or to (conjugated, start, end) of its highlight with spans.
+        # The number reported to progress is the position in the file in bytes.
+        # The build may run in another thread than the searches, it has its own patterns
+        patternCache = LRUCache(PATTERN_CACHE_SIZE)
+        f = open(self.path, 'rb')
+        try:
+            position = 0
+            for i, line in enumerate(f):
+                position += len(line)
+                if not i % 2:
+                    example = line
+                else:
+                    colorExample = line.decode('utf8')
+                    words = self.words(colorExample)
+                    conjugated = self.conjugated(colorExample)
+                    if spans:
+                        highlights = self.highlightSpans(words, example.decode('utf8'), colorExample, patternCache)
+                        yield i - 1, dict((word, (word in conjugated,) + highlights[word]) for word in words)
+                    else:
+                        yield i - 1, dict((word, (word in conjugated,)) for word in words)
+                if progress and not i % PROGRESS_STEP:
+                    progress(position)
+        finally:
+            f.close()
+
+    def words(self, line):
+        # The indexed words of a colour line
+        words = set()
+        for word in self.splitter(line)[1:-1]:
+            if word.endswith("~"):
+                word = word[:-1]
+            if not word.isdigit():
+                words.add(word)
+        return words
+
+    def conjugated(self, colorExample):
+        # Words of a colour line which are conjugated in the sentence, i.e. followed by their {form}
+        conjugated = set()
+        for column in colorExample.split()[1:]:
+            if u"{" in column:
+                conjugated.update(word.rstrip(u"~") for word in SPLITTER.split(column))
+        return conjugated
+
+    def sentenceScores(self, df):
+        # Ranks the examples, by line number, by how close they are to the ideal length
+        # and by how common the other words in them are
+        scores = array('f')
+        f = open(self.path, 'rb')
+        try:
+            for i, line in enumerate(f):
+                if not i % 2:
+                    example = line
+                    continue
+                length = len(example.decode('utf8').split("#ID=")[0][3:].split('\t')[0])
+                # Mean of the log document frequencies, the higher the more common the words are
+                frequencies = [math.log(df[word]) for word in self.words(line.decode('utf8')) if word in df]
+                commonness = sum(frequencies) / len(frequencies) if frequencies else 0.0
+                scores.append(COMMON_WEIGHT * commonness - LENGTH_WEIGHT * abs(length - IDEAL_LENGTH))
+                scores.append(0.0)
+        finally:
+            f.close()
+        return scores
+
+    def highlightSpans(self, words, example, colorExample, patternCache=None):
+        # Where each of the words is highlighted in the Japanese sentence
+        question = example.split("#ID=")[0][3:].split('\t')[0]
+        spans = {}
+        for word in words:
+            colorExpression = self.colorExpression(word, colorExample, patternCache)
+            start = question.find(colorExpression)
+            end = start + len(colorExpression)
+            spans[word] = (start, end) if 0 <= start and end < NOSPAN else (NOSPAN, NOSPAN)
+        return spans
+
     def buildDictionary(self):
-        for i, line in enumerate(self.content[1::2]):
-            words = set(self.splitter(line)[1:-1])
+        for j, words in self.sentenceWords():
             for word in words:
-                if word.endswith("~"):
-                    word = word[:-1]
-                if word in self.dictionary and not word.isdigit():
-                    self.dictionary[word].append(2*i)
-                elif not word.isdigit():
-                    self.dictionary[word]=[]
-                    self.dictionary[word].append(2*i)
+                if word in self.dictionary:
+                    self.dictionary[word].append(j)
+                else:
+                    self.dictionary[word] = [j]
     
     def splitter(self, txt):
         # Split the columns
-        txt = re.compile('\s|\[|\]|\(|\{|\)|\}').split(txt)
+        txt = SPLITTER.split(txt)
         for i in range(0,len(txt)):
             if txt[i] == "~":
                 txt[i-2] = txt[i-2] + "~"
@@ -70,53 +295,400 @@ class Dictionary():
                 txt[i] = ""
         return [x for x in txt if x]
         
-    def findExamples(self, expression):
-        # Searches for examples only up to the MAX constant
-        maxItems = MAX        
-        infoQuestion = []
-        infoAnswer = []    
-        examplesQuestion = []
-        examplesAnswer = []           
+    def firstExamples(self, expression, seed=None):
+        # The first MAX (question, answer) examples and the seed they were shuffled with. They are cached
+        # per expression and seed, so repeated searches show the same examples. Call with the lock held.
+        key = (expression, seed)
+        results = self.resultCache.get(key)
+        if results is None:
+            shuffleSeed = random.random() if seed is None else seed
+            examples = list(islice(self.examples(expression, random.Random(shuffleSeed)), MAX))
+            results = (shuffleSeed, examples)
+            self.resultCache[key] = results
+        return results
+
+    def findExamples(self, expression, seed=None):
+        # The first MAX examples as (questions, answers), the same as the first page of a cursor
+        with self.lock:
+            examples = self.firstExamples(expression, seed)[1]
+        return ([question for question, answer in examples], [answer for question, answer in examples])
+
+    def hasExamples(self, expression):
+        # Checks the index only, without building the examples
+        if self.isQuery(expression):
+            return bool(self.matchQuery(self.parseQuery(expression)))
+        return self.resolve(expression) is not None
+
+    def isQuery(self, expression):
+        return QUERY_SEPARATOR.search(expression.strip()) is not None
 
+    def parseQuery(self, query):
+        # Splits a query into clauses joined by OR. Each clause is a list of terms that must all be
+        # in the example and a list of terms, marked by a leading "-" or NOT, that must not.
+        clauses = [([], [])]
+        exclude = False
+        for token in QUERY_SEPARATOR.split(query.strip()):
+            if token in (u"OR", u"|"):
+                clauses.append(([], []))
+            elif token == u"NOT":
+                exclude = True
+            elif token != u"AND":
+                if token.startswith(u"-") and len(token) > 1:
+                    token = token[1:]
+                    exclude = True
+                clauses[-1][1 if exclude else 0].append(token)
+                exclude = False
+        return clauses
+
+    def matchQuery(self, clauses):
+        # Sorted line numbers of the examples matching any of the clauses
+        matches = []
+        for required, excluded in clauses:
+            keys = set(self.resolve(term) for term in required)
+            if not keys or None in keys:
+                continue
+            postings = sorted((self.lookup(key)[0] for key in keys), key=len)
+            lines = postings[0]
+            for other in postings[1:]:
+                lines = intersect(lines, other)
+            for term in excluded:
+                key = self.resolve(term)
+                if key is not None:
+                    lines = difference(lines, self.lookup(key)[0])
+            matches.append(lines)
+        return union(matches) if matches else []
+
+    def matchKeys(self, text, limit=MAX_KEYS):
+        # Dictionary keys starting with the text, followed by the keys containing it elsewhere
+        if not text:
+            return []
+        if isinstance(self.dictionary, Index):
+            keys = self.dictionary.prefixed(text, limit)
+            if len(keys) < limit:
+                keys.extend(self.dictionary.containing(text, limit - len(keys)))
+            return keys
+        # The pickled dictionary has no key index and has to be scanned
+        keys = sorted(key for key in self.dictionary if text in key)
+        keys.sort(key=lambda key: not key.startswith(text))
+        return keys[:limit]
+
+    def resolve(self, expression):
+        # Returns the dictionary key of the expression, or None if there is no example for it
         if expression in self.dictionary:
-            index = self.dictionary[expression]
-            index = random.sample(index, min(len(index),maxItems))
-            maxItems -= len(index)
-            for j in index:
-                # Split the example into normal form and one with conjugations
-                example = self.content[j].split("#ID=")[0][3:]
-                colorExample = self.content[j+1]
-                
-                regexpConjugated = "(?:\(*%s\)*)(?:\([^\s]+?\))*(?:\[\d+\])*(?:\{(.+?)\})" %expression
-                matchConjugated = re.search(regexpConjugated, colorExample)
-                regexpReading = "(?:\s([^\s]*?))(?:\(%s\))" % expression
-                matchReading = re.search(regexpReading, colorExample)
-                # Check if we found the example via dictionary form and highlight the word
-                if matchConjugated:
-                    colorExpression = matchConjugated.group(1)
-                    example = example.replace(colorExpression,'<FONT COLOR="#0000ff">%s</FONT>' % colorExpression)
-                # Check if we found the example by reading and highlight the word
-                elif matchReading:
-                    colorExpression = matchReading.group(1)
-                    example = example.replace(colorExpression,'<FONT COLOR="#0000ff">%s</FONT>' % colorExpression)
-                # Otherwise the word is in the same form that we searched - just highlight it
-                else:
-                    example = example.replace(expression,'<FONT COLOR="#0000ff">%s</FONT>' %expression)
-                # Adds the Japanese [0] and English [1] sentence containing the expression
-                examplesQuestion.append("%s" % example.split('\t')[0])
-                examplesAnswer.append("%s" % example.split('\t')[1])
+            return expression
+        # If expression is not in dictionary, try stripping the brackets and slashes
+        match = SLASH.search(expression)
+        if match:
+            return self.resolve(match.group(1))
+
+        match = BRACKETS.search(expression)
+        if match:
+            if match.group(1).strip():
+                return self.resolve("%s%s" % (match.group(1), match.group(2)))
+        return None
+
+    def searchExamples(self, expression, rng):
+        # Searches for examples only up to the MAX constant
+        examples = list(islice(self.examples(expression, rng), MAX))
+        return ([question for question, answer in examples], [answer for question, answer in examples])
+
+    def cursor(self, expression, seed=None):
+        # Pages through all the examples of the expression, see ExampleCursor
+        return ExampleCursor(self, expression, seed)
+
+    def examples(self, expression, rng):
+        # Generates the Japanese and English sentence of every example of the expression,
+        # best first when ranked and in a random order otherwise
+        if self.isQuery(expression):
+            return self.queryExamples(expression, rng)
+        return self.wordExamples(expression, rng)
+
+    def wordExamples(self, expression, rng):
+        expression = self.resolve(expression)
+        if expression is None:
+            return
+        index, spans = self.lookup(expression)
+        # Positions in the posting list, so that the spans can be found as well
+        if self.isRanked():
+            chosen = self.rankedPositions(self.dictionary.find(expression), len(index))
         else:
-            # If expression is not in dictionary, try stripping the brackets and slashes
-            match = re.search(u"(.*?)[／/]", expression)
-            if match:
-                return self.findExamples(match.group(1))
-    
-            match = re.search(u"(.*?)[(（](.+?)[)）]", expression)
-            if match:
-                if match.group(1).strip():
-                    return self.findExamples("%s%s" % (match.group(1), match.group(2)))
-        
-        # Add sentences found into list
-        infoQuestion.extend(examplesQuestion)
-        infoAnswer.extend(examplesAnswer)
-        return (infoQuestion,infoAnswer)
\ No newline at end of file
+            chosen = shuffled(len(index), rng)
+        for k in chosen:
+            span = spans[2*k:2*k+2] if spans else None
+            yield self.highlight(expression, index[k], span)
+
+    def rankedPositions(self, i, count):
+        # The postings of a term are ranked in the index already, they are read a page at a time
+        for start in xrange(0, count, MAX):
+            for k in self.dictionary.ranked(i, start, start + MAX):
+                yield k
+
+    def queryExamples(self, query, rng):
+        # Searches for examples matching the query, highlighting every required term found in them
+        clauses = self.parseQuery(query)
+        lines = self.matchQuery(clauses)
+        keys = set(self.resolve(term) for required, excluded in clauses for term in required)
+        terms = [(key,) + self.lookup(key) for key in keys if key is not None]
+
+        if self.isRanked():
+            order = self.rank(lines)
+        else:
+            order = (lines[k] for k in shuffled(len(lines), rng))
+        for j in order:
+            found = []
+            for key, index, spans in terms:
+                k = contains(index, j)
+                if k >= 0:
+                    found.append((key, spans[2*k:2*k+2] if spans else None))
+            yield self.highlightTerms(found, j)
+
+    def lookup(self, expression):
+        # Postings of the expression, along with their highlight spans if the index has them
+        if isinstance(self.dictionary, Index) and self.dictionary.hasSpans:
+            i = self.dictionary.find(expression)
+            return self.dictionary.postings(i), self.dictionary.spans(i)
+        return self.dictionary[expression], None
+
+    def isRanked(self):
+        return RANKED and isinstance(self.dictionary, Index) and self.dictionary.hasScores
+
+    def rank(self, lines):
+        # Generates the lines best scored first, ties in corpus order. The heap is built in linear time,
+        # so the first page costs little more than a scan however many lines match.
+        scores = self.dictionary.sentenceScores()
+        heap = [(-scores[j], j) for j in lines]
+        heapq.heapify(heap)
+        while heap:
+            yield heapq.heappop(heap)[1]
+
+    def patterns(self, expression, patternCache=None):
+        # Compiled patterns finding the conjugated form and the reading of the expression in a colour line,
+        # kept in the searches' cache unless another one is given
+        if patternCache is None:
+            patternCache = self.patternCache
+        patterns = patternCache.get(expression)
+        if patterns is None:
+            escaped = re.escape(expression)
+            patterns = (re.compile(CONJUGATED % escaped), re.compile(READING % escaped))
+            patternCache[expression] = patterns
+        return patterns
+
+    def colorExpression(self, expression, colorExample, patternCache=None):
+        # Check if we found the example via dictionary form or by reading and return the word as it is in the example,
+        # otherwise the word is in the same form that we searched
+        conjugated, reading = self.patterns(expression, patternCache)
+        match = conjugated.search(colorExample) or reading.search(colorExample)
+        return match.group(1) if match else expression
+
+    def findColorExpression(self, expression, j, question, span=None):
+        # The form of the expression in the example on line j, taken from its span if there is one
+        if span and span[0] != NOSPAN:
+            return question[span[0]:span[1]]
+        return self.colorExpression(expression, self.content[j+1])
+
+    def example(self, j):
+        # The Japanese and English sentence of the example on line j
+        return self.content[j].split("#ID=")[0][3:].split('\t')
+
+    def highlight(self, expression, j, span=None):
+        # Returns the Japanese and English sentence of the example on line j with the expression highlighted
+        example = self.example(j)
+        colorExpression = self.findColorExpression(expression, j, example[0], span)
+        colored = HIGHLIGHT % colorExpression
+        return example[0].replace(colorExpression, colored), example[1].replace(colorExpression, colored)
+
+    def highlightTerms(self, terms, j):
+        # Highlights several (expression, span) terms in one pass, so overlapping forms are not nested
+        example = self.example(j)
+        forms = set(self.findColorExpression(expression, j, example[0], span) for expression, span in terms)
+        forms = sorted((form for form in forms if form), key=len, reverse=True)
+        if not forms:
+            return example[0], example[1]
+        pattern = re.compile(u"|".join(re.escape(form) for form in forms))
+        colored = lambda match: HIGHLIGHT % match.group(0)
+        return pattern.sub(colored, example[0]), pattern.sub(colored, example[1])
+
+
+# Registry of the corpora, each searched through its own Dictionary and index. Adding a corpus
+# builds only its own index. Searches fan out to every corpus and the results are merged by QUOTAS.
+class Dictionaries():
+
+    def __init__(self):
+        self.dictionaries = []
+        for path in corpusPaths():
+            self.register(path)
+
+    def register(self, path):
+        dictionary = Dictionary(path)
+        self.dictionaries.append(dictionary)
+        return dictionary
+
+    def close(self):
+        for dictionary in self.dictionaries:
+            dictionary.close()
+
+    def isRebuilding(self):
+        return any(dictionary.rebuilding for dictionary in self.dictionaries)
+
+    def rebuild(self, background=False, onDone=None):
+        # In the background the corpora are rebuilt in parallel and onDone is called once all of them are done.
+        # Returns False if a rebuild is running already, the request is then ignored.
+        if self.isRebuilding():
+            return False
+        results = []
+        def rebuilt(success):
+            results.append(success)
+            if onDone and len(results) == len(self.dictionaries):
+                onDone(all(results))
+        for dictionary in self.dictionaries:
+            dictionary.rebuild(background, rebuilt if background else None)
+        if not background and onDone:
+            onDone(True)
+        return True
+
+    def quotas(self, limit=MAX):
+        # Examples reserved for each corpus, in the order of the registry
+        fixed = sum(QUOTAS.get(dictionary.name, 0) for dictionary in self.dictionaries)
+        shared = [dictionary for dictionary in self.dictionaries if dictionary.name not in QUOTAS]
+        share, rest = divmod(max(limit - fixed, 0), len(shared)) if shared else (0, 0)
+        quotas = []
+        for dictionary in self.dictionaries:
+            if dictionary.name in QUOTAS:
+                quotas.append(QUOTAS[dictionary.name])
+            else:
+                # The first corpora get what cannot be shared equally
+                quotas.append(share + (1 if rest > 0 else 0))
+                rest -= 1
+        return quotas
+
+    def findExamples(self, expression, seed=None):
+        results = [dictionary.findExamples(expression, seed) for dictionary in self.dictionaries]
+        return merge(results, self.quotas(), MAX)
+
+    def cursor(self, expression, seed=None):
+        return MergedCursor([dictionary.cursor(expression, seed) for dictionary in self.dictionaries], self.quotas)
+
+    def hasExamples(self, expression):
+        return any(dictionary.hasExamples(expression) for dictionary in self.dictionaries)
+
+    def matchKeys(self, text, limit=MAX_KEYS):
+        keys = []
+        for dictionary in self.dictionaries:
+            keys.extend(key for key in dictionary.matchKeys(text, limit) if key not in keys)
+        return keys[:limit]
+
+
+# Pages through the examples of a Dictionary in a stable order. Each fetch continues where the last
+# one stopped. The first MAX examples come from the result cache; those after them are looked up
+# and highlighted only once they are fetched.
+class ExampleCursor():
+
+    def __init__(self, dictionary, expression, seed):
+        self.dictionary = dictionary
+        self.expression = expression
+        self.seed = seed
+        self.generation = dictionary.generation
+        self.first = None
+        self.rest = None
+        self.position = 0
+        self.exhausted = False
+
+    def fetch(self, count):
+        # The next count examples as (questions, answers), fewer once there are no more
+        with self.dictionary.lock:
+            if self.dictionary.generation != self.generation:
+                # The index was rebuilt, the positions of the examples are no longer valid
+                self.exhausted = True
+            examples = [] if self.exhausted else self.next(count)
+        if len(examples) < count:
+            self.exhausted = True
+        return ([question for question, answer in examples], [answer for question, answer in examples])
+
+    def next(self, count):
+        if self.first is None:
+            self.shuffleSeed, self.first = self.dictionary.firstExamples(self.expression, self.seed)
+        examples = self.first[self.position:self.position + count]
+        if len(examples) < count and len(self.first) == MAX:
+            if self.rest is None:
+                # Continues the order of the cached examples after them
+                rest = self.dictionary.examples(self.expression, random.Random(self.shuffleSeed))
+                self.rest = islice(rest, MAX, None)
+            examples.extend(islice(self.rest, count - len(examples)))
+        self.position += len(examples)
+        return examples
+
+
+# Pages through the examples of several corpora, each page shared by the quotas of the corpora
+class MergedCursor():
+
+    def __init__(self, cursors, quotas):
+        self.cursors = cursors
+        self.quotas = quotas
+        self.exhausted = False
+
+    def fetch(self, count):
+        questions = []
+        answers = []
+        for cursor, quota in zip(self.cursors, self.quotas(count)):
+            question, answer = cursor.fetch(min(quota, count - len(questions)))
+            questions.extend(question)
+            answers.extend(answer)
+        # What a corpus cannot fill is given to the others
+        for cursor in self.cursors:
+            if len(questions) < count and not cursor.exhausted:
+                question, answer = cursor.fetch(count - len(questions))
+                questions.extend(question)
+                answers.extend(answer)
+        self.exhausted = all(cursor.exhausted for cursor in self.cursors)
+        return questions, answers
+
+
+def corpusPaths():
+    # The Tanaka corpus followed by the corpora in CORPORA
+    paths = [FILE]
+    if os.path.isdir(CORPORA):
+        paths.extend(os.path.join(CORPORA, name) for name in sorted(os.listdir(CORPORA)) if name.endswith(".utf"))
+    return paths
+
+
+def isIndexed(path):
+    # Whether the corpus can be opened without building its offsets or its index
+    base = os.path.splitext(path)[0]
+    if readOffsets(path, base + ".offsets") is None:
+        return False
+    try:
+        index = Index(base + ".index", path)
+    except (IOError, OSError, IndexFormatError, struct.error):
+        return False
+    try:
+        return index.hasSpans == SPANS
+    finally:
+        index.close()
+
+
+def shuffled(count, rng):
+    # Generates the numbers below count in a random order. The Fisher-Yates shuffle is run lazily,
+    # remembering only the swapped positions, so taking a few of them does not cost O(count).
+    swapped = {}
+    for i in xrange(count):
+        j = rng.randint(i, count - 1)
+        yield swapped.get(j, j)
+        swapped[j] = swapped.get(i, i)
+
+
+def merge(results, quotas, limit):
+    # Takes up to its quota of the (questions, answers) of each corpus, then fills the rest
+    # of the limit with the remaining examples, in the order of the corpora
+    questions = []
+    answers = []
+    taken = []
+    for (question, answer), quota in zip(results, quotas):
+        count = min(len(question), quota, limit - len(questions))
+        questions.extend(question[:count])
+        answers.extend(answer[:count])
+        taken.append(count)
+    for (question, answer), count in zip(results, taken):
+        extra = min(len(question) - count, limit - len(questions))
+        questions.extend(question[count:count+extra])
+        answers.extend(answer[count:count+extra])
+    return questions, answers